@@ -0,0 +1,47 @@
+import os, sys, json, time, argparse
+
+file_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(file_dir))
+
+from pathlib import Path
+
+from parallel import go_redi_parallel
+
+
+def main(args):
+
+    path_building = Path(file_dir).parent/'examples/example_building.json'
+
+    with open(path_building) as f:
+        building_data = json.loads(f.read())
+
+    building_dicts = [building_data for _ in range(args.b)]
+
+    max_workers = args.w or os.cpu_count() or 1
+
+    print(f"{args.b} building(s) x {args.n} realizations, {os.cpu_count()} CPU(s) available\n")
+    print(f"  {'workers':>8} {'time [s]':>10} {'realizations/s':>16} {'speedup':>8}")
+
+    serial_time = None
+    for n_workers in range(1, max_workers + 1) :
+
+        start_time = time.perf_counter()
+        go_redi_parallel(building_dicts=building_dicts, n_realizations=args.n, seed=123, n_workers=n_workers)
+        elapsed_time = time.perf_counter() - start_time
+
+        if serial_time is None :
+            serial_time = elapsed_time
+
+        print(f"  {n_workers:>8} {elapsed_time:>10.2f} {args.b * args.n / elapsed_time:>16.1f} {serial_time / elapsed_time:>7.2f}x")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Scaling of go_redi_parallel with the number of worker processes')
+    parser.add_argument('-n', type=int, default=200, help='Number of realizations per building [int]')
+    parser.add_argument('-b', type=int, default=4, help='Number of buildings [int]')
+    parser.add_argument('-w', type=int, default=None, help='Maximum number of workers [int] (optional - defaults to the number of CPUs)')
+
+    args = parser.parse_args()
+
+    main(args)
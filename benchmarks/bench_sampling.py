@@ -0,0 +1,70 @@
+import os, sys, timeit, argparse
+
+file_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(file_dir))
+
+import numpy as np
+from scipy.stats import lognorm, truncnorm
+
+from utils.stat_utils import RandomPool, truncnorm_ppf, lognormal_ppf
+
+
+def time_per_call(stmt, number : int) -> float :
+
+    # Best of 5 repeats, in microseconds per call
+    return min(timeit.repeat(stmt, number=number, repeat=5)) / number * 1e6
+
+
+def main(args):
+
+    n_samples = args.n
+
+    rng = np.random.default_rng(0)
+    rnd_num = rng.random(n_samples)
+
+    # Parameters of the max workers per building distribution in the example building
+    mean = np.full(n_samples, 28.0)
+    stdev = np.full(n_samples, 9.083)
+
+    print(f"Zero-truncated normal inverse CDF ({n_samples} samples)\n")
+
+    scipy_scalar = time_per_call(lambda: truncnorm.ppf(rnd_num[0], a=(0-mean[0])/stdev[0], b=np.inf, loc=mean[0], scale=stdev[0]), number=2000)
+    fast_scalar = time_per_call(lambda: truncnorm_ppf(rnd_num[0], mean[0], stdev[0]), number=2000)
+    print(f"  per scalar    scipy {scipy_scalar:10.2f} us    truncnorm_ppf {fast_scalar:10.2f} us    speedup {scipy_scalar/fast_scalar:6.1f}x")
+
+    scipy_batch = time_per_call(lambda: truncnorm.ppf(rnd_num, a=(0-mean)/stdev, b=np.inf, loc=mean, scale=stdev), number=20)
+    fast_batch = time_per_call(lambda: truncnorm_ppf(rnd_num, mean, stdev), number=20)
+    print(f"  batch         scipy {scipy_batch:10.2f} us    truncnorm_ppf {fast_batch:10.2f} us    speedup {scipy_batch/fast_batch:6.1f}x")
+    print(f"  per sample in batch                     truncnorm_ppf {fast_batch/n_samples:10.4f} us    vs scipy scalar {scipy_scalar/(fast_batch/n_samples):6.0f}x\n")
+
+    print("Uniform random numbers\n")
+
+    generator = np.random.default_rng(0)
+    pool = RandomPool(np.random.default_rng(0))
+
+    generator_scalar = time_per_call(lambda: generator.random(), number=100000)
+    pool_scalar = time_per_call(lambda: pool.random(), number=100000)
+    print(f"  per scalar    generator {generator_scalar:10.3f} us    RandomPool {pool_scalar:10.3f} us    speedup {generator_scalar/pool_scalar:6.1f}x\n")
+
+    # Parameters of the worker capacity distribution in the example building
+    beta = np.full(n_samples, 0.2)
+
+    print(f"Lognormal inverse CDF ({n_samples} samples)\n")
+
+    scipy_scalar = time_per_call(lambda: lognorm.ppf(rnd_num[0], s=beta[0], scale=np.exp(np.log(mean[0]))), number=2000)
+    fast_scalar = time_per_call(lambda: lognormal_ppf(rnd_num[0], mean[0], beta[0]), number=2000)
+    print(f"  per scalar    scipy {scipy_scalar:10.2f} us    lognormal_ppf {fast_scalar:10.2f} us    speedup {scipy_scalar/fast_scalar:6.1f}x")
+
+    scipy_batch = time_per_call(lambda: lognorm.ppf(rnd_num, s=beta, scale=np.exp(np.log(mean))), number=20)
+    fast_batch = time_per_call(lambda: lognormal_ppf(rnd_num, mean, beta), number=20)
+    print(f"  batch         scipy {scipy_batch:10.2f} us    lognormal_ppf {fast_batch:10.2f} us    speedup {scipy_batch/fast_batch:6.1f}x\n")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark of the inverse CDF samplers in utils.stat_utils')
+    parser.add_argument('-n', type=int, default=10000, help='Number of samples in the batch benchmarks [int]')
+
+    args = parser.parse_args()
+
+    main(args)
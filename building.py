@@ -1,5 +1,11 @@
 
-from typing import Dict, Any
+from typing import Dict, List, Any, Optional, Iterable
+from pathlib import Path
+import threading
+
+import numpy as np
+
+from utils.components_utils import load_components_index, read_components, get_components_arrays
 
 
 class ComponentsLibrary() : 
@@ -7,9 +13,184 @@ class ComponentsLibrary() :
      def __init__(self, components_lib_dict) :
           self.library = components_lib_dict
 
+          # Struct-of-arrays views of the fields used by the engine, only for the components used so far (see component_ids),
+          # so that unused entries of the library are never read
+          self._arrays = None
+          self._ids : Dict[str,int] = {}
+
+          # A library is shared by the runs of every thread (see load_components_library), the IDs are registered and the
+          # arrays rebuilt under this lock, so the arrays always have a row for every ID given
+          self._lock = threading.Lock()
+
      def __getitem__(self, index):
         return self.library[index]
 
+     def __getstate__(self) :
+
+          # The lock is not pickled, e.g., when the library is sent to the workers of go_redi_parallel
+          state = self.__dict__.copy()
+          del state["_lock"]
+          return state
+
+     def __setstate__(self, state) :
+
+          self.__dict__.update(state)
+          self._lock = threading.Lock()
+
+     def component_ids(self, NISTRs : Iterable[str]) -> np.ndarray :
+
+          # Dense integer ID of each component, i.e., its row in the arrays (seq, rds, long_lead, ...). The components not 
+          # used yet are appended, so the IDs already given do not change, and the arrays are rebuilt on next use
+          NISTRs = list(NISTRs)
+
+          ids = self._ids
+          if any(NISTR not in ids for NISTR in NISTRs) :
+               with self._lock :
+                    # New IDs are registered in a copy, then the IDs and the arrays are swapped together
+                    ids = dict(self._ids)
+                    for NISTR in NISTRs :
+                         if NISTR not in ids :
+                              # Unknown components raise a KeyError before they get an ID
+                              self[NISTR]
+                              ids[NISTR] = len(ids)
+
+                    if len(ids) > len(self._ids) :
+                         self._arrays = None
+                         self._ids = ids
+
+          return np.array([ids[NISTR] for NISTR in NISTRs], dtype=int)
+
+     # Sequences of each component, [nComponents x 2]
+     @property
+     def seq(self) -> np.ndarray :
+          return self._get_arrays()["seq"]
+
+     # Number of damage states of each component
+     @property
+     def n_ds(self) -> np.ndarray :
+          return self._get_arrays()["n_ds"]
+
+     # Repair class of each damage state, zero-padded, [nComponents x max rds_len]
+     @property
+     def rds(self) -> np.ndarray :
+          return self._get_arrays()["rds"]
+
+     @property
+     def rds_len(self) -> np.ndarray :
+          return self._get_arrays()["rds_len"]
+
+     # Long lead time of each damage state (days), zero-padded, [nComponents x max long_lead_len]
+     @property
+     def long_lead(self) -> np.ndarray :
+          return self._get_arrays()["long_lead"]
+
+     @property
+     def long_lead_len(self) -> np.ndarray :
+          return self._get_arrays()["long_lead_len"]
+
+     @property
+     def has_long_lead(self) -> np.ndarray :
+          return self._get_arrays()["has_long_lead"]
+
+     def _get_arrays(self) -> Dict[str,np.ndarray] :
+
+          arrays = self._arrays
+
+          if arrays is None :
+               with self._lock :
+                    if self._arrays is None :
+                         self._arrays = get_components_arrays({NISTR: self[NISTR] for NISTR in self._ids})
+                    arrays = self._arrays
+
+          return arrays
+
+
+class LazyComponentsLibrary(ComponentsLibrary) :
+
+     # Components library read from a JSON file on demand, only the components that are accessed are parsed and kept in memory. 
+     # The byte offsets of every component are stored in an index in the cache directory (rebuilt whenever the file changes)
+     def __init__(self, 
+                  json_path : Path, 
+                  index_path : Optional[Path]=None) :
+
+          self.json_path = Path(json_path)
+          self.offsets = load_components_index(self.json_path, index_path)
+
+          # Components parsed so far
+          super().__init__(components_lib_dict={})
+
+     def __getitem__(self, index):
+          
+          if index not in self.library :
+               self.load([index])
+
+          return self.library[index]
+
+     def component_ids(self, NISTRs : Iterable[str]) -> np.ndarray :
+
+          NISTRs = list(NISTRs)
+          self.load(NISTRs)
+
+          return super().component_ids(NISTRs)
+
+     def __contains__(self, index) :
+          return index in self.offsets
+
+     def __len__(self) :
+          return len(self.offsets)
+
+     def load(self, NISTRs : Iterable[str]) :
+
+          # Parse the components not loaded yet, reading the file once
+          missing = {NISTR: self.offsets[NISTR] for NISTR in NISTRs if NISTR not in self.library}
+
+          if missing :
+               self.library.update(read_components(self.json_path, missing))
+
+
+class DamageTensor() :
+
+     # Damage quantities of every component as a dense array of shape (nComponents, nDS, nTotalFloor),
+     # the damage states include DS0 and are zero-padded up to the largest number of damage states
+     def __init__(self, component_damage : Dict[str,List[List[float]]]) :
+
+          self.components = list(component_damage.keys())
+          self.index = {NISTR: i for i, NISTR in enumerate(self.components)}
+
+          # Number of damage states of each component (including DS0)
+          self.n_ds = np.array([len(DS_by_floor) for DS_by_floor in component_damage.values()], dtype=int)
+
+          max_n_ds = int(np.max(self.n_ds)) if len(self.n_ds) else 1
+          n_floors = max([len(floor_ds) for DS_by_floor in component_damage.values() for floor_ds in DS_by_floor], default=0)
+
+          self.values = np.zeros((len(self.components), max_n_ds, n_floors))
+          for i, DS_by_floor in enumerate(component_damage.values()) :
+               for ds, floor_ds in enumerate(DS_by_floor) :
+                    self.values[i, ds, :len(floor_ds)] = floor_ds
+
+
+class ConsequenceTensor() :
+
+     # Consequences of every component as a dense array of shape (nComponents, nConsequences, nTotalFloor, nDS), 
+     # the consequences are in the input order (the first one is the cost and the second one the time), 
+     # the damage states exclude DS0 and are zero-padded up to the largest number of damage states
+     def __init__(self, total_consequences : Dict[str,List[List[List[float]]]]) :
+
+          self.components = list(total_consequences.keys())
+          self.index = {NISTR: i for i, NISTR in enumerate(self.components)}
+
+          consequences = list(total_consequences.values())
+
+          n_types = max([len(damage) for damage in consequences], default=0)
+          n_floors = max([len(damage_type) for damage in consequences for damage_type in damage], default=0)
+          n_ds = max([len(floor) for damage in consequences for damage_type in damage for floor in damage_type], default=0)
+
+          self.values = np.zeros((len(self.components), n_types, n_floors, n_ds))
+          for i, damage in enumerate(consequences) :
+               for j, damage_type in enumerate(damage) :
+                    for floor, floor_ds in enumerate(damage_type) :
+                         self.values[i, j, floor, :len(floor_ds)] = floor_ds
+
 
 class Building() :
     
@@ -28,6 +209,10 @@ class Building() :
 
           self.total_consequences = building_dict['total_consequences']
 
+          # Dense arrays of the damage and consequences, indexed by NISTR, built once for all the aggregations
+          self.damage_tensor = DamageTensor(self.damage_by_component)
+          self.consequence_tensor = ConsequenceTensor(self.total_consequences)
+
           self.floor_areas = building_dict['floor_areas']
           self.replacement_cost = building_dict['replacement_cost']
           self.replacement_time = building_dict['replacement_time']
@@ -94,6 +279,14 @@ class Building() :
           # Construction delay parameters
           self.con_delay_params = risk_parameters["impeding_factors"]["contractor_mobilization_delay_seismic"]
 
+          # Use the rc1 contractor delay parameters for the sequences with a maximum repair class of 1 (optional - off by default,
+          # i.e., the rc23 parameters are used for every sequence as in earlier versions, which keeps seeded results unchanged)
+          self.con_delay_rc1_by_seq = bool(self.con_delay_params.get("rc1_by_seq", False))
+
+          # Contractor delay parameters of each sequence as arrays, [rc1, rc23] x n_sequences
+          self.con_delay_theta_by_seq = np.array([self.con_delay_params[rc]["theta_by_seq"] for rc in ["rc1", "rc23"]], dtype=np.float64)
+          self.con_delay_sigma_by_seq = np.array([self.con_delay_params[rc]["sigma_by_seq"] for rc in ["rc1", "rc23"]], dtype=np.float64)
+
           # Long lead time parameters
           self.long_lead_threshold = risk_parameters["impeding_factors"]["longlead"]["threshold"]
           self.long_lead_distribution = risk_parameters["impeding_factors"]["longlead"]["distribution"]
@@ -112,6 +305,17 @@ class Building() :
           self.repair_sequence = None
           self.impeding_delays = None
           self.max_delay = None
+
+          # Realization-invariant attributes, computed once by the prepare stage (see prepare_building)
+          self.prepared = False
+          self.total_repair_cost = None
+          self.max_workers_mean = None
+          self.struct_workers_mean = None
+          self.recommended_workers_mean_struct = None
+          self.recommended_workers_mean = None
+          self.worker_constraint_mean = None
+          self.repair_class_inputs = None
+          self.longlead_inputs = None
           self.n_repair_goal = 3 # Number of repair goals
           self.n_sequences = 8 # Total number of sequences
           self.n_non_struc_sequence = 7 # Number of non-structural sequences
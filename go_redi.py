@@ -1,18 +1,25 @@
-import json, os, sys
+import json, os, sys, hashlib, threading
 
 file_dir = os.path.dirname(__file__)
 sys.path.append(file_dir)
 
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Sequence, Union, Tuple, Iterable
+from collections import OrderedDict
 from pathlib import Path
 import numpy as np
 
-from utils.stat_utils import set_seed, sample_dist, get_percentile, gen_random
-from building import Building, ComponentsLibrary
-from impeding_delays import get_impeding_delays
-from repair_schedules.get_repair_schedule import get_repair_schedule
+from utils.stat_utils import (set_seed, sample_dist, sample_dist_array, get_percentile, gen_random_array, 
+                              new_entropy, get_realization_pool, use_random_pool)
+from utils.components_utils import ENGINE_FIELDS, load_components_library_file
+from utils.timing_utils import timed_stage, start_timing_run
+from building import Building, ComponentsLibrary, LazyComponentsLibrary, DamageTensor, ConsequenceTensor
+from impeding_delays import get_impeding_delays, get_total_repair_cost, get_longlead_inputs
+from repair_schedules.get_repair_schedule import get_repair_schedule, get_recommended_workers_mean, get_worker_constraint_mean
 
-components_lib=None
+# Components libraries loaded so far, by key (see get_components_library_key), the least recently used first
+COMPONENTS_LIB_CACHE_SIZE = 4
+_components_lib_cache : "OrderedDict[Tuple[str,...], ComponentsLibrary]" = OrderedDict()
+_components_lib_cache_lock = threading.Lock()
 
 def go_redi(building_dict : dict, 
             components_lib_dict : Optional[dict]=None, 
@@ -22,28 +29,300 @@ def go_redi(building_dict : dict,
     if seed or burn_in : 
         set_seed(seed, burn_in) 
 
-    global components_lib
+    start_timing_run()
+
+    print(f"******* Running REDi™ for building {building_dict['_id']} *******\n")
+
+    building = Building(building_dict=building_dict)
+
+    components_lib = load_components_library(components_lib_dict, NISTRs=building.damage_by_component.keys())
+
+    # Compute the realization-invariant inputs
+    prepare_building(building=building, components_lib=components_lib)
+
+    # Run a single stochastic realization
+    run_realization(building=building, components_lib=components_lib)
+
+    return output_results(building=building)
+
+
+
+def go_redi_batch(building_dict : dict, 
+                  n_realizations : int,
+                  components_lib_dict : Optional[dict]=None, 
+                  seed=None, 
+                  burn_in=None) -> dict :
+
+    """
+    Runs n_realizations stochastic realizations of REDi for a single building
+    
+    The building is parsed and its damage aggregated once, only the stochastic part of the 
+    analysis is repeated for each realization. Every realization draws from its own random stream, 
+    spawned from the seed (see get_realization_pool), so realization k always gives the same result 
+    regardless of how many realizations are run or in which order.
+    
+    Args:
+    building_dict (dict): the building input
+    n_realizations (int): number of realizations to run
+    components_lib_dict (dict): components library (optional - the built-in library is used if None, a ComponentsLibrary such as a LazyComponentsLibrary is used as is)
+    seed (int): seed of the run (optional - fresh entropy is used if not provided, and returned under "seed")
+    burn_in (int): number of random numbers to discard at the start of every realization stream
+    
+    Returns:
+    dict: results stacked by realization, i.e., the first axis of every array is the realization
+    """
+
+    if n_realizations < 1 :
+        raise ValueError(f"Error, the number of realizations must be at least 1, {n_realizations} was provided")
+
+    # Entropy of the run, every realization stream is spawned from it
+    entropy = seed if seed else new_entropy()
+
+    start_timing_run()
+
+    print(f"******* Running REDi™ for building {building_dict['_id']} with {n_realizations} realizations *******\n")
+
+    building = Building(building_dict=building_dict)
+
+    components_lib = load_components_library(components_lib_dict, NISTRs=building.damage_by_component.keys())
+
+    # Compute the realization-invariant inputs once for all realizations
+    prepare_building(building=building, components_lib=components_lib)
+
+    results = run_realizations(building=building, 
+                               components_lib=components_lib, 
+                               realizations=range(n_realizations), 
+                               entropy=entropy, 
+                               burn_in=burn_in)
+
+    print('Analysis done!\n')
+
+    return {
+        "seed" : entropy,
+        "components" : list(building.damage_by_component_all_floors.keys()),
+        "damage_by_component_all_DS" : building.damage_by_component_all_DS,
+        "component_qty" : building.component_qty,
+        **results,
+    }
+
+
+
+def run_realizations(building : Building, 
+                     components_lib : ComponentsLibrary,
+                     realizations : Sequence[int],
+                     entropy : int,
+                     burn_in : Optional[int]=None,
+                     record_allocation : bool=False) -> Dict[str,Any] :
+
+    # Column order of the repair class array
+    component_list = list(building.damage_by_component_all_floors.keys())
+
+    n_realizations = len(realizations)
+    n_repair_goal = building.n_repair_goal
+
+    # Initialize results
+    repair_class = np.zeros((n_realizations, len(component_list)), dtype=int)
+    building_total_downtime = np.zeros((n_realizations, n_repair_goal))
+    max_delay = np.zeros(n_realizations)
+    struct_repairs = np.zeros((n_realizations, n_repair_goal))
+    total_span = np.zeros((n_realizations, n_repair_goal))
+    impeding_delays : Dict[str,List[Any]] = {}
+
+    for index, realization in enumerate(realizations) :
+
+        # Each realization draws from its own stream
+        with use_random_pool(get_realization_pool(entropy, realization, burn_in)) :
+            run_realization(building=building, components_lib=components_lib, record_allocation=record_allocation)
+
+        repair_class[index] = [building.repair_class[NISTR] for NISTR in component_list]
+        building_total_downtime[index] = building.building_total_downtime
+        max_delay[index] = building.max_delay[0]
+
+        for goal, schedule in enumerate(building.repair_schedule) :
+            struct_repairs[index][goal] = schedule["struct_repairs"]
+            total_span[index][goal] = schedule["total_span"]
+
+        for key, delay in building.impeding_delays.items() :
+            impeding_delays.setdefault(key, []).append(delay)
+
+    return {
+        "realizations" : np.array(realizations, dtype=int),
+        "repair_class" : repair_class,
+        "impeding_delays" : {key: np.array(delays) for key, delays in impeding_delays.items()},
+        "max_delay" : max_delay,
+        "struct_repairs" : struct_repairs,
+        "total_span" : total_span,
+        "building_total_downtime" : building_total_downtime,
+    }
+
 
-    if not components_lib_dict and not components_lib :
-        print("Loading components\n")
+
+def load_components_library(components_lib_dict : Optional[Union[dict, ComponentsLibrary]]=None,
+                            NISTRs : Optional[Iterable[str]]=None) -> ComponentsLibrary :
+
+    """
+    Returns the components library of a run, from a cache of the last COMPONENTS_LIB_CACHE_SIZE libraries used
+
+    The built-in library is keyed by its file, i.e., it is reloaded if the file changes, and a dictionary by its content
+    (the fields used by the engine of the components NISTRs), so that dictionaries equal on these components share the 
+    same library.
+    A dictionary already in the cache (the same object) is found without hashing its content, so a dictionary must not
+    be modified once it has been used, pass a new one instead.
+    The same library is returned to every thread, its component IDs and arrays are thread-safe (see ComponentsLibrary),
+    but the runs of each thread must draw from their own random pool (see use_random_pool).
+
+    Args:
+    components_lib_dict (dict): components library (optional - the built-in library is used if None, a ComponentsLibrary
+                                such as a LazyComponentsLibrary is used as is)
+    NISTRs (list): the components used, e.g., those of the buildings to run (optional - every component of the library if None)
+
+    Returns:
+    ComponentsLibrary: the components library
+    """
+
+    # A components library provided as such, e.g., a LazyComponentsLibrary, is used directly
+    if isinstance(components_lib_dict, ComponentsLibrary) :
+        return components_lib_dict
+
+    with _components_lib_cache_lock :
+
+        # Identity fast path, the same dictionary as a cached library
+        if components_lib_dict :
+            for key, components_lib in _components_lib_cache.items() :
+                if components_lib.library is components_lib_dict :
+                    _components_lib_cache.move_to_end(key)
+                    return components_lib
 
         # Get the directory of the current script
-        current_dir = Path(__file__).resolve().parent
-        filepath =current_dir/'data/components_library.json'
+        filepath = Path(__file__).resolve().parent/'data/components_library.json'
+
+        key = get_components_library_key(components_lib_dict, filepath, NISTRs=NISTRs)
+
+        if key in _components_lib_cache :
+            _components_lib_cache.move_to_end(key)
+            return _components_lib_cache[key]
+
+        if not components_lib_dict :
+            print("Loading components\n")
+
+            # Load the fields used by the engine, through the compiled library (rebuilt if the JSON file changed)
+            components_lib_dict = load_components_library_file(filepath)
 
-        # open the JSON file
-        f = open(filepath)
-        components_lib_dict = json.load(f)
-        f.close()
         components_lib = ComponentsLibrary(components_lib_dict=components_lib_dict)
-        
-    elif components_lib_dict and not components_lib :
-        components_lib = ComponentsLibrary(components_lib_dict=components_lib_dict) 
 
-    print(f"******* Running REDi™ for building {building_dict['_id']} *******\n")
+        # Add to the cache, evicting the least recently used libraries
+        _components_lib_cache[key] = components_lib
+        while len(_components_lib_cache) > COMPONENTS_LIB_CACHE_SIZE :
+            _components_lib_cache.popitem(last=False)
+
+    return components_lib
+
+
+
+def get_components_library_key(components_lib_dict : Optional[dict], 
+                               filepath : Path,
+                               NISTRs : Optional[Iterable[str]]=None) -> Tuple[str,...] :
+
+    # The built-in library is identified by its file, and whether it changed since it was loaded
+    if not components_lib_dict :
+        stat = os.stat(filepath)
+        return ("file", str(filepath), str(stat.st_mtime_ns), str(stat.st_size))
+
+    # Other libraries by their content, only the components used and their fields used by the engine matter
+    NISTRs = components_lib_dict.keys() if NISTRs is None else sorted(set(NISTRs))
+
+    content = json.dumps([[NISTR, _get_engine_fields(components_lib_dict.get(NISTR))] for NISTR in NISTRs], default=repr)
+
+    return ("content", hashlib.sha256(content.encode('utf-8')).hexdigest())
+
+
+
+def _get_engine_fields(component : Any) -> Any :
+
+    # The fields used by the engine that the component has, anything else than a dictionary is kept as is
+    if isinstance(component, dict) :
+        return {field: component[field] for field in ENGINE_FIELDS if field in component}
+
+    return component
+
+
+
+def clear_components_library_cache() :
+
+    with _components_lib_cache_lock :
+        _components_lib_cache.clear()
+
+
+
+def prepare_building(building : Building, 
+                     components_lib : ComponentsLibrary) :
+
+    """
+    Prepare stage, computes once the inputs that are the same for every realization and stores them on the building
+
+    The arrays are made read-only, run_realization (the sample stage) then only does the stochastic part of the analysis.
+    """
+
+    nTotalFloor = building.nTotalFloor
+
+    # Parse the components of the building in one go
+    if isinstance(components_lib, LazyComponentsLibrary) :
+        components_lib.load(building.damage_by_component.keys())
+
+    # Aggregate the damage
+    process_building_damage(building=building)
+
+    # Get total quantity of every component across the entire building
+    building.component_qty = get_component_qty_all_floor(building.components)
+
+    # Get consequence by component by component by floor
+    building.consequence_by_component_by_floor = get_consequence_by_component_by_floor(building.total_consequences, 
+                                                                                       consequence_tensor=building.consequence_tensor)
+
+    # Get the total building repair cost
+    building.total_repair_cost = get_total_repair_cost(building=building)
+
+    # Get the means of the worker distributions
+    building.max_workers_mean = get_max_workers_mean(building=building)
+
+    building.struct_workers_mean = _read_only(np.array(get_struct_workers_mean(building=building)))
+
+    building.recommended_workers_mean_struct = _read_only(np.array(get_recommende_means_STRUCT(building=building, 
+                                                                                               components_lib=components_lib,
+                                                                                               damage_qty=building.damage_by_component_all_DS, 
+                                                                                               nTotalFloor=nTotalFloor)))
+
+    building.recommended_workers_mean = _read_only(get_recommended_workers_mean(building=building, 
+                                                                                components_lib=components_lib,
+                                                                                floor_areas=building.floor_areas, 
+                                                                                damage_qty=building.damage_by_component_all_DS, 
+                                                                                nTotalFloor=nTotalFloor,
+                                                                                n_non_struc_sequence=building.n_non_struc_sequence))
+
+    building.worker_constraint_mean = _read_only(np.array(get_worker_constraint_mean(building=building)))
+
+    building.repair_class_inputs = {key: _read_only(value) for key, value in get_repair_class_inputs(building=building, 
+                                                                                                 components_lib=components_lib).items()}
+
+    building.longlead_inputs = {key: _read_only(value) for key, value in get_longlead_inputs(building=building, 
+                                                                                         components_lib=components_lib,
+                                                                                         component_qty=building.component_qty).items()}
+
+    building.prepared = True
+
+
+
+def _read_only(array : np.ndarray) -> np.ndarray :
+
+    array.setflags(write=False)
+
+    return array
+
+
+
+@timed_stage("damage_aggregation")
+def process_building_damage(building : Building) :
 
-    building = Building(building_dict=building_dict)
-    
     # Get the total number of floors
     nTotalFloor = building.nTotalFloor
 
@@ -54,10 +333,20 @@ def go_redi(building_dict : dict,
     comp_damage = building.damage_by_component
 
     # Get the damage by component_all_floors
-    building.damage_by_component_all_floors = get_damage_by_component_all_floors(comp_damage)
+    building.damage_by_component_all_floors = get_damage_by_component_all_floors(comp_damage, damage_tensor=building.damage_tensor)
 
     # Re-organize damage states
-    building.damage_by_component_all_DS = get_damage_by_component_all_DS(comp_damage, nTotalFloor)
+    building.damage_by_component_all_DS = get_damage_by_component_all_DS(comp_damage, nTotalFloor, damage_tensor=building.damage_tensor)
+
+
+
+def run_realization(building : Building, 
+                    components_lib : ComponentsLibrary,
+                    record_allocation : bool=True) :
+
+    # Sample stage, the realization-invariant inputs are only computed the first time
+    if not building.prepared :
+        prepare_building(building=building, components_lib=components_lib)
 
     # Calculate parameters before repair scheduling
     pre_calc = calculate_before_scheduling(building=building,components_lib=components_lib)
@@ -67,7 +356,8 @@ def go_redi(building_dict : dict,
                                           components_lib=components_lib,
                                           struc_repair_days=pre_calc["struc_repair_days"], 
                                           nonstruct_contractor_delays=pre_calc["nonstruct_contractor_delays"],
-                                          max_workers=pre_calc["max_workers"])
+                                          max_workers=pre_calc["max_workers"],
+                                          record_allocation=record_allocation)
     
 
     building.repair_schedule = repair_schedule
@@ -84,49 +374,38 @@ def go_redi(building_dict : dict,
 
     building.building_total_downtime = building_total_downtime
 
-    return output_results(building=building)
 
 
+def get_damage_by_component_all_floors(component_damage : Dict[str,List[List[float]]],
+                                       damage_tensor : Optional[DamageTensor]=None) : 
 
-def get_damage_by_component_all_floors(component_damage : Dict[str,List[List[float]]]) : 
+    if damage_tensor is None :
+        damage_tensor = DamageTensor(component_damage)
 
-    damage_by_component_all_floors = {}
-
-    for NISTR, DS_by_floor in component_damage.items():
-
-        num_ds = len(DS_by_floor)
+    # Sum the damage of each damage state over all floors, [nComponents x nDS]
+    floor_sums = damage_tensor.values[:, 1:, :].sum(axis=2)
 
-        floor_sums = np.zeros(num_ds-1)
-        for floor in range(1, num_ds) : 
-            floor_ds = DS_by_floor[floor]
-            sum_floor = np.sum(floor_ds)
-            floor_sums[floor-1] = sum_floor
-
-        damage_by_component_all_floors[NISTR] = floor_sums
+    damage_by_component_all_floors = {}
+    for i, NISTR in enumerate(damage_tensor.components) :
+        damage_by_component_all_floors[NISTR] = floor_sums[i, :damage_tensor.n_ds[i]-1]
 
     return damage_by_component_all_floors
 
 
 
 def get_damage_by_component_all_DS(component_damage : Dict[str,List[List[float]]], 
-                                   nTotalFloor : int):
+                                   nTotalFloor : int,
+                                   damage_tensor : Optional[DamageTensor]=None):
     
-    DS_by_component_all_DS = {}
-    
-    for NISTR, DS_by_floor in component_damage.items():
-
-        DS_by_floor_t = list(zip(*DS_by_floor))
-
-        # compObj = components_lib[NISTR]
-        # n_ds = compObj["n_ds"]
+    if damage_tensor is None :
+        damage_tensor = DamageTensor(component_damage)
 
-        sum_ds = []
+    # Sum the damaged states (i.e., excluding DS0) on each floor, [nComponents x nTotalFloor]
+    ds_sums = damage_tensor.values[:, 1:, :nTotalFloor].sum(axis=1)
 
-        for floor in range(0, nTotalFloor) : 
-            floor_ds = DS_by_floor_t[floor][1:]
-            sum_ds.append(np.sum(floor_ds) )
-         
-        DS_by_component_all_DS[NISTR] = sum_ds
+    DS_by_component_all_DS = {}
+    for i, NISTR in enumerate(damage_tensor.components) :
+        DS_by_component_all_DS[NISTR] = list(ds_sums[i])
 
     return DS_by_component_all_DS
 
@@ -139,20 +418,12 @@ def calculate_before_scheduling(building : Building,
     nTotalFloor = building.nTotalFloor
 
     # Get total quantity of every component across the entire building
-    component_qty = get_component_qty_all_floor(building.components)
-    building.component_qty = component_qty
+    component_qty = building.component_qty
 
     # assign repair class
     repair_class = assign_repair_class(building=building,components_lib=components_lib)
     building.repair_class = repair_class
 
-    # Get the total building cost
-    total_cost = building.total_consequences
-
-    # Get consequence by component by component by floor
-    consequence_by_component_by_floor = get_consequence_by_component_by_floor(total_cost)
-    building.consequence_by_component_by_floor = consequence_by_component_by_floor
-    
     n_sequences = building.n_sequences
     n_repair_goal = building.n_repair_goal
 
@@ -229,79 +500,117 @@ def get_component_qty_all_floor(components_by_floor : List[Dict[str,Any]]):
 
 
 
+@timed_stage("assign_repair_class")
 def assign_repair_class(building : Building, 
                         components_lib : ComponentsLibrary):
     
-    damage = building.damage_by_component_all_floors
+    repair_class = sample_repair_class(building=building, components_lib=components_lib)
 
-    component_qty = building.component_qty
+    return dict(zip(building.damage_by_component_all_floors.keys(), repair_class.tolist()))
 
-    # Initialize result
-    repair_class_by_component = {}
 
-    # Extract repair class risk parameters
-    distribution_rc = building.distribution_rc
-    theta_rc = building.theta_rc
-    beta_rc = building.beta_rc
+def sample_repair_class(building : Building, 
+                        components_lib : ComponentsLibrary,
+                        n_realizations : Optional[int]=None) -> np.ndarray :
 
-    for NISTR, comp_damage in damage.items():
-        
-        # Get component data
-        compObj = components_lib[NISTR]
-        rds = compObj["rds"]
+    """
+    Samples the repair class of every component, in the order of damage_by_component_all_floors
 
-        # print('NISTR',NISTR)
+    One random number is drawn per damaged component, in the same order as assigning the repair classes one 
+    component at a time. With n_realizations, the repair classes of n_realizations consecutive realizations are 
+    sampled at once, i.e., the result is the same as calling assign_repair_class n_realizations times.
 
-        # Extract first realization (TODO: Edit this once realizations are removed)
-        comp_damage = [comp_damage[0]]
+    Args:
+    building (Building): the building
+    components_lib (ComponentsLibrary): components library
+    n_realizations (int): number of realizations (optional - a single realization if None)
 
-        # print('comp_damage',comp_damage)
- 
-        # Identify the index of the maximum damage state
-        DS_max_index = next((i for i in reversed(range(len(comp_damage))) if comp_damage[i] > 0), None)
+    Returns:
+    np.ndarray: repair class of each component, [nComponents] or [n_realizations x nComponents]
+    """
 
-        # print('DS_max_index',DS_max_index)
+    repair_class_inputs = building.repair_class_inputs or get_repair_class_inputs(building=building, components_lib=components_lib)
 
-        # If no damage, set repair class to zero
-        if DS_max_index is None:
-            repair_class_by_component[NISTR] = 0
-        else:
-            # Extract repair class of maximum damage state
-            rDS_max = rds[DS_max_index]
+    damaged = repair_class_inputs["damaged"]
+    rc_max = repair_class_inputs["rc_max"][damaged]
+    rc_downgrade = repair_class_inputs["rc_downgrade"][damaged]
+    p_rc_max = repair_class_inputs["p_rc_max"][damaged]
+
+    shape = (len(damaged),) if n_realizations is None else (n_realizations, len(damaged))
+
+    rnd_num = gen_random_array(shape[:-1] + (len(rc_max),))
+
+    # Sample repair class, the max repair class or the one notch lower
+    repair_class = np.zeros(shape, dtype=int)
+    repair_class[..., damaged] = np.where(p_rc_max > rnd_num, rc_max, rc_downgrade)
 
-            # Get proportion of components in maximum damage state
-            DS_max_ratio = comp_damage[DS_max_index] / component_qty[NISTR]
+    return repair_class
 
-            # Get probability of being in the repair class of the max damage state
-            p_rDS_max = get_percentile(distribution_rc, theta_rc, beta_rc, DS_max_ratio)
 
-            rnd_num = gen_random()
-            # print('rnd',rnd_num)
+def get_repair_class_inputs(building : Building, 
+                            components_lib : ComponentsLibrary) -> Dict[str,np.ndarray] :
 
-            # Sample repair class
-            if p_rDS_max > rnd_num :
-                # Assign max repair class
-                repair_class_by_component[NISTR] = rDS_max
-            else:
-                # Get the repair class index that is one notch lower than the repair class of the max damage state
-                rDS_prev_max_index = next((i for i in range(DS_max_index - 1, -1, -1) if rds[i] < rDS_max), None)
+    """
+    Gets the realization-invariant part of the repair class of every component, in the order of damage_by_component_all_floors
 
-                # If there is no previous repair, asesign repair class to zero
-                if rDS_prev_max_index is None:
-                    repair_class_by_component[NISTR] = 0
-                # If there is a previous repair class, assign that one!
-                else:
-                    repair_class_by_component[NISTR] = rds[rDS_prev_max_index]
+    Returns:
+    dict: whether each component is damaged, the repair class of its maximum damage state, the repair class one notch
+    lower (zero if there is none) and the probability of being in the repair class of the maximum damage state
+    """
 
-    return repair_class_by_component
+    damage = building.damage_by_component_all_floors
+
+    NISTRs = list(damage.keys())
+    n_components = len(NISTRs)
+
+    # Extract first realization (TODO: Edit this once realizations are removed)
+    comp_damage = np.array([comp_damage[:1] for comp_damage in damage.values()], dtype=np.float64).reshape(n_components, 1)
+    n_ds = comp_damage.shape[1]
+
+    ids = components_lib.component_ids(NISTRs)
+    rds = components_lib.rds[ids]
+
+    # Identify the index of the maximum damage state, components with no damage have a repair class of zero
+    is_damaged = comp_damage > 0
+    damaged = is_damaged.any(axis=1)
+    DS_max_index = n_ds - 1 - np.argmax(is_damaged[:, ::-1], axis=1)
+
+    rows = np.arange(n_components)
+
+    # Extract repair class of maximum damage state
+    rc_max = np.where(damaged, rds[rows, DS_max_index], 0)
+
+    # Get the repair class that is one notch lower than the repair class of the max damage state, i.e., of the 
+    # highest damage state below the max one with a lower repair class
+    is_lower = (np.arange(rds.shape[1]) < DS_max_index[:, None]) & (rds < rc_max[:, None])
+    prev_index = rds.shape[1] - 1 - np.argmax(is_lower[:, ::-1], axis=1)
+    rc_downgrade = np.where(is_lower.any(axis=1), rds[rows, prev_index], 0)
+
+    # Get probability of being in the repair class of the max damage state, from the proportion of components in that state
+    p_rc_max = np.zeros(n_components)
+    component_qty = np.array([building.component_qty[NISTR] for NISTR, is_damaged in zip(NISTRs, damaged) if is_damaged], dtype=np.float64)
+    DS_max_ratio = comp_damage[rows[damaged], DS_max_index[damaged]] / component_qty
+    p_rc_max[damaged] = get_percentile(building.distribution_rc, building.theta_rc, building.beta_rc, DS_max_ratio)
+
+    return {"damaged" : damaged,
+            "rc_max" : rc_max,
+            "rc_downgrade" : rc_downgrade,
+            "p_rc_max" : p_rc_max}
 
 
 # Sums consequences across all damage states for each component on each floor
-def get_consequence_by_component_by_floor(consequence_total_cost : Dict[str,List[List[float]]]):
+def get_consequence_by_component_by_floor(consequence_total_cost : Dict[str,List[List[float]]],
+                                          consequence_tensor : Optional[ConsequenceTensor]=None):
     
+    if consequence_tensor is None :
+        consequence_tensor = ConsequenceTensor(consequence_total_cost)
+
+    # Sum over the damage states, [nComponents x nConsequences x nTotalFloor]
+    ds_sums = consequence_tensor.values.sum(axis=3)
+
     consequence_by_component_by_floor = {}
-    for NISTR, damage in consequence_total_cost.items() :
-        consequence_by_component_by_floor[NISTR] = [[np.sum(floor) for floor in damage_type] for damage_type in damage]
+    for i, NISTR in enumerate(consequence_tensor.components) :
+        consequence_by_component_by_floor[NISTR] = [list(floor_sums) for floor_sums in ds_sums[i]]
 
     return consequence_by_component_by_floor
 
@@ -316,24 +625,27 @@ def get_repair_sequence_by_floor(repair_class_by_component : Dict[str, int],
                                  n_sequences : int,
                                  n_repair_goal : int):
 
-    repair_sequence = [[[0]*n_repair_goal for _ in range(n_sequences)] for _ in range(nTotalFloor)]
+    # repair_sequence: [nTotalFloor x n_sequences x n_repair_goal]
+    repair_sequence = np.zeros((nTotalFloor, n_sequences, n_repair_goal))
 
-    for NISTR, repair_class in repair_class_by_component.items():
-         
-        repair_class = int(repair_class)
-        if repair_class > 0 :
-            compObj = components_lib[NISTR]
-            sequence_index = int(compObj["seq"][0])
-            
-            # sequence_index = components_lib[NISTR]["seq"][1] + 1 # +1 to convert 0->1
-            # repair_time: [nRealization x [nTotalFloor]]
-            repair_time = consequence_by_component_by_floor[NISTR][1]
-            
-            # add_repair_sequence_contribution_each_component(sequence_index, repair_class, repair_time, repair_sequence, filters, nTotalFloor)
-            # realizations_for_goal = [findall(filter, repair_class) for filter in filters]
-            for goal_index in range(repair_class):
-                for floor in range(nTotalFloor):
-                    repair_sequence[floor][sequence_index][goal_index] += repair_time[floor]
+    # Get the components with a repair class
+    repair_classes = np.array([int(repair_class) for repair_class in repair_class_by_component.values()], dtype=int)
+    damaged = [NISTR for NISTR, repair_class in zip(repair_class_by_component.keys(), repair_classes) if repair_class > 0]
+
+    if len(damaged) == 0 :
+        return repair_sequence
+
+    ids = components_lib.component_ids(damaged)
+    sequence_index = components_lib.seq[ids, 0]
+
+    # repair_time: [nComponents x nTotalFloor]
+    repair_time = np.array([consequence_by_component_by_floor[NISTR][1][:nTotalFloor] for NISTR in damaged])
+
+    # Each component adds its repair time to every goal below its repair class
+    component_index, goal_index = np.nonzero(np.arange(n_repair_goal) < repair_classes[repair_classes > 0][:, None])
+
+    # np.add.at adds in component order, i.e., the same order as a loop over the components
+    np.add.at(repair_sequence, (slice(None), sequence_index[component_index], goal_index), repair_time[component_index].T)
 
     return repair_sequence
 
@@ -358,6 +670,7 @@ def get_repair_sequence(repair_sequence_by_floor : List[List[float]],
 
 
 
+@timed_stage("get_structural_repair_time")
 def get_structural_repair_time(building : Building, 
                                components_lib : ComponentsLibrary, 
                                max_workers : float, 
@@ -367,24 +680,21 @@ def get_structural_repair_time(building : Building,
     
     damage_qty = building.damage_by_component_all_DS
 
-    means_STRUCT = get_recommende_means_STRUCT(building=building, 
-                                               components_lib=components_lib,
-                                               damage_qty=damage_qty, 
-                                               nTotalFloor=nTotalFloor)
+    # Get the mean worker capacity on each floor, computed once by the prepare stage
+    means_STRUCT = building.recommended_workers_mean_struct
+    if means_STRUCT is None :
+        means_STRUCT = get_recommende_means_STRUCT(building=building, 
+                                                   components_lib=components_lib,
+                                                   damage_qty=damage_qty, 
+                                                   nTotalFloor=nTotalFloor)
 
 
     # Get relevant risk parameters
     distribution = building.workers_cap_distribution
     beta = building.workers_cap_beta
 
-    worker_cap = [0. for _ in range(nTotalFloor)]
-    for floor in range(nTotalFloor) :
-        means_struct_floor = means_STRUCT[floor]
-        # if means_struct_floor : 
-        sample = sample_dist(distribution,means_struct_floor,beta)
-        # else : 
-        #     sample = 0.0
-        worker_cap[floor] = sample
+    # Sample the worker capacity on each floor
+    worker_cap = sample_dist_array(distribution, means_STRUCT, beta)
     
     recommended_worker_sum = np.sum(worker_cap)
 
@@ -405,65 +715,71 @@ def get_recommende_means_STRUCT(building : Building,
                                 damage_qty : Dict[str,Any], 
                                 nTotalFloor : int):
 
-    means = [0. for _ in range(nTotalFloor)]
-    for NISTR, damage in damage_qty.items() :
-    
-        seq = components_lib[NISTR]["seq"][0]
-        if seq > 0:
-            continue
-        add_component_recommended_workers_STRUCT(building, means, damage)
-    return means
+    nWorker_per_unit = building.nworkers_recommended_mean_struct
 
+    # Get the structural components, i.e., in sequence 0
+    NISTRs = list(damage_qty.keys())
+    ids = components_lib.component_ids(NISTRs)
+    is_struct = components_lib.seq[ids, 0] <= 0
 
+    damage = np.array([damage_qty[NISTR][:nTotalFloor] for NISTR, struct in zip(NISTRs, is_struct) if struct]).reshape(-1, nTotalFloor)
 
-def add_component_recommended_workers_STRUCT(building : Building, 
-                                             means : List[float], 
-                                             damage_qty : List[float]):
+    # Sums over the first axis add the components one after the other, i.e., in the same order as a loop
+    means = (nWorker_per_unit * damage).sum(axis=0)
 
-    nTotalFloor = building.nTotalFloor
-
-    nWorker_per_unit = building.nworkers_recommended_mean_struct
-    
-    for floor in range(nTotalFloor):
-        means[floor] += nWorker_per_unit * damage_qty[floor]
+    return list(means)
 
 
 
 def get_max_workers(building : Building):
 
+    # Get the mean, computed once by the prepare stage
+    mean = building.max_workers_mean
+    if mean is None :
+        mean = get_max_workers_mean(building=building)
+
+    # Sample max workers
+    return sample_dist("Normal", mean, building.max_workers_sigma)
+
+
+
+def get_max_workers_mean(building : Building) -> float :
+
     totalArea = building.total_floor_area
 
     # Extract relevant risk parameters
     max_workers_minimum = building.max_workers_minimum
     max_workers_slope = building.max_workers_slope
     max_workers_x_cutoff = building.max_workers_x_cutoff
-    max_workers_sigma = building.max_workers_sigma
 
     # Calculate mean
-    mean = max_workers_minimum + max(0, totalArea - max_workers_x_cutoff) * max_workers_slope
-
-    # Sample max workers
-    return sample_dist("Normal", mean, max_workers_sigma)
+    return max_workers_minimum + max(0, totalArea - max_workers_x_cutoff) * max_workers_slope
 
 
 
 def get_struct_workers(building : Building):
-    
-    floorareas = building.floor_areas
+
+    # Get the mean on each floor, computed once by the prepare stage
+    mean_by_floor = building.struct_workers_mean
+    if mean_by_floor is None :
+        mean_by_floor = get_struct_workers_mean(building=building)
 
     # Get risk parameters
-    max_workers_per_struct_divider = building.max_workers_per_struct_divider
     distribution = building.workers_cap_distribution
     beta = building.workers_cap_beta
 
-    mean_by_floor = [floor  / max_workers_per_struct_divider for floor in floorareas]  
-
     # Sample the number of workers
-    results = []
-    for j in range(len(mean_by_floor)) :
-        results.append(sample_dist(distribution, mean_by_floor[j], beta))
+    return sample_dist_array(distribution, mean_by_floor, beta)
+
+
+
+def get_struct_workers_mean(building : Building) -> List[float] :
+    
+    floorareas = building.floor_areas
+
+    max_workers_per_struct_divider = building.max_workers_per_struct_divider
 
-    return results
+    return [floor  / max_workers_per_struct_divider for floor in floorareas]  
 
 
 
@@ -489,6 +805,7 @@ def process_downtime(repair_schedule : List[Dict[str,float]],
 
 
 
+@timed_stage("output_results")
 def output_results(building : Building) -> dict : 
 
     repair_schedule = building.repair_schedule
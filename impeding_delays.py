@@ -1,8 +1,9 @@
 
 import numpy as np
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Tuple
 
-from utils.stat_utils import sample_dist
+from utils.stat_utils import sample_dist, sample_dist_array
+from utils.timing_utils import timed_stage
 
 from building import Building, ComponentsLibrary
 
@@ -11,23 +12,17 @@ from building import Building, ComponentsLibrary
 ###################################
 
 
+@timed_stage("get_impeding_delays")
 def get_impeding_delays(building : Building,
                         components_lib : ComponentsLibrary,
                         repair_sequence : List[List[float]],
                         component_qty : Dict[str,float]) :
     
 
-    # Get the total building repair cost
-    total_consequences = building.total_consequences
-
-    total_repair_cost = 0.0
-    for _,consequences in total_consequences.items() :
-        
-        cost_list = consequences[0]
-
-        # Sum up the costs on each floor
-        for cost_floor in cost_list :
-            total_repair_cost+= np.sum(cost_floor)
+    # Get the total building repair cost, computed once by the prepare stage
+    total_repair_cost = building.total_repair_cost
+    if total_repair_cost is None :
+        total_repair_cost = get_total_repair_cost(building=building)
 
     # Get the building replacement cost 
     replacement_cost = building.replacement_cost
@@ -105,11 +100,156 @@ def get_impeding_delays(building : Building,
     return max_delay, impeding_delays
 
 
+# Columns of the delays returned by get_impeding_delays_batch, followed by the contractor mobilization delay (including
+# the long lead time) of every sequence, i.e., the structural sequence then the nonstructural ones
+IMPEDING_DELAY_TYPES = ["inspection_delay", "engineering_mobilization_delay", "financing_delay", "permit_delay"]
+
+# Delay paths, indexed by the max delay path returned by get_impeding_delays_batch: inspection + financing, inspection +
+# engineering mobilization + permit, and inspection + structural contractor mobilization (including the long lead time)
+IMPEDING_DELAY_PATHS = ["financing", "engineering_permit", "contractor"]
+
+
+def get_impeding_delays_batch(building : Building,
+                              components_lib : ComponentsLibrary,
+                              repair_sequence : np.ndarray,
+                              component_qty : Dict[str,float]) -> Tuple[np.ndarray, np.ndarray, np.ndarray] :
+
+    """
+    Batch version of get_impeding_delays, samples the impeding delays of N realizations at once
+
+    Each delay type is drawn as a vector, the realizations that need a sample of that type in realization order, and 
+    the branch logic is evaluated with masks. The random numbers are consumed type by type (inspection, engineering 
+    mobilization, financing, permit, contractor mobilization then long lead times), so for N=1 the result is the same 
+    as get_impeding_delays.
+
+    Note that go_redi and go_redi_batch still call get_impeding_delays once per realization: go_redi_batch samples each
+    realization with its own random stream, so drawing the delays of all the realizations from one stream would change
+    its results. This function is for callers sampling all the realizations from the global stream.
+
+    Args:
+    building (Building): the building
+    components_lib (ComponentsLibrary): components library
+    repair_sequence (np.ndarray): repair time of each realization, sequence and repair goal, [N x n_sequences x n_repair_goal]
+    component_qty (dict): total quantity of every component
+
+    Returns:
+    tuple: the max delay of each realization [N], the delay path giving the max delay of each realization [N] (index into
+    IMPEDING_DELAY_PATHS, the first path on ties), and the delays of each realization [N x (len(IMPEDING_DELAY_TYPES) + n_sequences)],
+    with the columns IMPEDING_DELAY_TYPES followed by the contractor mobilization delays of each sequence
+    """
+
+    repair_sequence = np.asarray(repair_sequence, dtype=np.float64)
+    n_realizations = repair_sequence.shape[0]
+
+    # Get the total building repair cost, computed once by the prepare stage
+    total_repair_cost = building.total_repair_cost
+    if total_repair_cost is None :
+        total_repair_cost = get_total_repair_cost(building=building)
+
+    # Calculate values based on replacement cost (convert replacement cost to $ from $M)
+    replacement_cost = building.replacement_cost
+    finance_cover = replacement_cost * building.loss_thresh_ratio * 1000000.0
+    available_fund = replacement_cost * building.available_fund_ratio * 1000000.0
+    deductible = replacement_cost * building.deductible_ratio * 1000000.0
+    insurance_limit = replacement_cost * building.insur_limit_ratio * 1000000.0
+
+    # Get the maximum repair classes associated with each repair sequence, [N] and [N x n_sequences]
+    max_nonstruct_rc = np.count_nonzero(repair_sequence > 0.0, axis=2)
+    max_struct_rc = max_nonstruct_rc[:, 0]
+
+    # Get inspection delay
+    insp_delay = sample_dist_array(building.inspection_distribution, building.inspection_theta, building.inspection_beta, size=n_realizations)
+
+    # Engineer mobilization delay, only if structural repairs are required
+    redesign_flag = total_repair_cost > finance_cover # Check to see if redesign is necessary
+    eng_delay_type = np.select([np.full(n_realizations, redesign_flag), max_struct_rc==3, max_struct_rc==1], ["redesign", "rc3", "rc1"], default="none")
+    eng_mob_delay = sample_delays(distribution=building.eng_mobilization_distribution, 
+                                  delay_type=eng_delay_type, 
+                                  theta={key: value["theta"] for key, value in building.eng_mobilization_theta.items() if isinstance(value, dict) and "theta" in value}, 
+                                  beta={key: value["beta"] for key, value in building.eng_mobilization_beta.items() if isinstance(value, dict) and "beta" in value})
+
+    # Finance delay, the same branch for every realization as it only depends on the building
+    finance_delay_type = get_finance_delay_type(building=building, 
+                                                building_cost=total_repair_cost, 
+                                                deductible=deductible, 
+                                                insurance_limit=insurance_limit, 
+                                                available_fund=available_fund)
+    
+    financing_delay_params = building.finance_delay_params
+    finance_delay = sample_delays(distribution=financing_delay_params["distribution"], 
+                                  delay_type=np.full(n_realizations, finance_delay_type or "none"), 
+                                  theta={key: value["theta"] for key, value in financing_delay_params.items() if isinstance(value, dict) and "theta" in value}, 
+                                  beta={key: value["beta"] for key, value in financing_delay_params.items() if isinstance(value, dict) and "beta" in value})
+
+    # Permit delay, no delay if no structural damage
+    if np.any(max_struct_rc==2) :
+        raise ValueError("Error, there is no permit delay for a maximum structural repair class of 2")
+
+    permit_delay_params = building.permit_delay_params
+    permit_delay = sample_delays(distribution=permit_delay_params["distribution"], 
+                                 delay_type=np.select([max_struct_rc==1, max_struct_rc==3], ["rc1", "rc3"], default="none"), 
+                                 theta={key: permit_delay_params[key]["theta"] for key in ["rc1", "rc3"]}, 
+                                 beta={key: permit_delay_params[key]["beta"] for key in ["rc1", "rc3"]})
+
+    # Contractor delay, then add long lead times
+    contractor_delays = get_contractor_mob_delay(building=building, max_nonstruct_rc=max_nonstruct_rc)
+
+    long_lead_times_by_seq = get_longlead_by_seq(building=building, 
+                                                 component_qty=component_qty, 
+                                                 components_lib=components_lib,
+                                                 n_realizations=n_realizations)
+
+    contractor_mobilization_delays = contractor_delays + long_lead_times_by_seq
+
+    delays = np.column_stack([insp_delay, eng_mob_delay, finance_delay, permit_delay, contractor_mobilization_delays])
+
+    # Get the maximum delay of each of the delay paths
+    delay_paths = np.stack([insp_delay + finance_delay,
+                            insp_delay + eng_mob_delay + permit_delay,
+                            insp_delay + contractor_mobilization_delays[:, 0]], axis=1)
+
+    max_delay_path = delay_paths.argmax(axis=1)
+
+    return delay_paths[np.arange(n_realizations), max_delay_path], max_delay_path, delays
+
+
 ######################################
 ########## HELPER FUNCTIONS ##########
 ######################################
 
 
+def sample_delays(distribution : str,
+                  delay_type : np.ndarray,
+                  theta : Dict[str,float],
+                  beta : Dict[str,float]) -> np.ndarray :
+
+    # One sample for every entry with a delay type other than "none", in C-order, with the parameters of its type
+    delays = np.zeros(np.shape(delay_type))
+
+    sampled = delay_type != "none"
+    if np.any(sampled) :
+        types = delay_type[sampled]
+        delays[sampled] = sample_dist_array(distribution, 
+                                            np.array([theta[key] for key in types], dtype=np.float64), 
+                                            np.array([beta[key] for key in types], dtype=np.float64))
+
+    return delays
+
+
+
+def get_total_repair_cost(building : Building) -> float :
+
+    # Cost of each component on each floor, summed over the damage states, [nComponents x nTotalFloor]
+    cost_by_floor = building.consequence_tensor.values[:, 0].sum(axis=2)
+
+    if cost_by_floor.size == 0 :
+        return 0.0
+
+    # Running sums (np.cumsum) add up in order, component by component and floor by floor
+    return np.cumsum(cost_by_floor)[-1]
+
+
+
 def get_max_rcs(repair_sequence : List[List[float]]):
 
     # Extract sequences
@@ -179,62 +319,58 @@ def get_finance_delay(building : Building,
                       insurance_limit : float, 
                       available_fund : float) -> float:
 
-    # Determine if there is a lack of funding
-    lack_fund_flag = (building_cost > available_fund)
+    # Get the parameters of the impeding curve, if there is a delay
+    finance_delay_type = get_finance_delay_type(building=building, 
+                                                building_cost=building_cost, 
+                                                deductible=deductible, 
+                                                insurance_limit=insurance_limit, 
+                                                available_fund=available_fund)
 
-    # Get finance method
-    finance_method = building.finance_method
+    if finance_delay_type is None :
+        return 0.
 
     financing_delay_params = building.finance_delay_params
 
-    # Only a delay if there is a lack of funding
-    if lack_fund_flag:
-
-        finance_delay_distribution = financing_delay_params['distribution']
-
-        # If the finance method is not insurance or if the total loss is less than the deductible...
-        if finance_method != "insurance" or building_cost < deductible:
+    finance_delay_distribution = financing_delay_params['distribution']
+    finance_delay_theta = financing_delay_params[finance_delay_type]['theta']
+    finance_delay_beta = financing_delay_params[finance_delay_type]['beta']
 
-            # parameters for impeding curve
-            finance_delay_theta = financing_delay_params['default']['theta']
-            finance_delay_beta = financing_delay_params['default']['beta']
+    # sample delay
+    return sample_dist(finance_delay_distribution, finance_delay_theta, finance_delay_beta)
 
-            # sample delay
-            delay = sample_dist(finance_delay_distribution, finance_delay_theta, finance_delay_beta)
 
-        # If the finance method is insurance and the total loss is more than the deductible...
-        else:
+def get_finance_delay_type(building : Building, 
+                           building_cost : float, 
+                           deductible : float, 
+                           insurance_limit : float, 
+                           available_fund : float) -> Optional[str] :
 
-            # If the financial loss is more than the insurance limit, then assume private loan delay (finance method 3)
-            if building_cost > insurance_limit:
-
-                # parameters for impeding curve
-                finance_delay_theta = financing_delay_params["private_loans"]["theta"]
-                finance_delay_beta = financing_delay_params["private_loans"]["beta"]
-
-                # sample delay
-                delay = sample_dist(finance_delay_distribution, finance_delay_theta, finance_delay_beta)
+    # Determine if there is a lack of funding
+    lack_fund_flag = (building_cost > available_fund)
 
-            # If the financial loss is less than the insurance limit...
-            else:
+    # Get finance method
+    finance_method = building.finance_method
 
-                # If deductible is more than the available fund, then assume regular insurance delay
-                if deductible > available_fund:
+    # Only a delay if there is a lack of funding
+    if not lack_fund_flag:
+        return None
 
-                    # parameters for impeding curve
-                    finance_delay_theta = financing_delay_params['default']['theta']
-                    finance_delay_beta = financing_delay_params['default']['beta']
+    # If the finance method is not insurance or if the total loss is less than the deductible...
+    if finance_method != "insurance" or building_cost < deductible:
+        return "default"
 
-                    # sample delay
-                    delay = sample_dist(finance_delay_distribution, finance_delay_theta, finance_delay_beta)
+    # If the finance method is insurance and the total loss is more than the deductible...
+    # If the financial loss is more than the insurance limit, then assume private loan delay (finance method 3)
+    if building_cost > insurance_limit:
+        return "private_loans"
 
-                # If the available funds are more than the deductible, then no delay!
-                else:
-                    delay = 0.
-    else:
-        delay = 0.
+    # If the financial loss is less than the insurance limit and the deductible is more than the available fund, 
+    # then assume regular insurance delay
+    if deductible > available_fund:
+        return "default"
 
-    return delay
+    # If the available funds are more than the deductible, then no delay!
+    return None
 
 
 def get_permit_delay(building : Building, 
@@ -265,100 +401,119 @@ def get_permit_delay(building : Building,
 
 
 def get_contractor_mob_delay(building : Building, 
-                             max_nonstruct_rc) -> List[float] :
-    
-    # Get the number of sequences
-    n_sequences = len(max_nonstruct_rc)
+                             max_nonstruct_rc) -> np.ndarray :
 
-    # Initialize result
-    delays = [0.0 for i in range(n_sequences)]
+    """
+    Samples the contractor mobilization delay of every sequence, in a single call
+
+    Works on the maximum repair classes of one realization ([n_sequences]) or of stacked realizations 
+    ([N x n_sequences]), one sample is drawn per sequence with nonstructural damage, in C-order.
 
-    con_delay_params = building.con_delay_params
+    The rc23 parameters are used for every sequence, unless the building input sets "rc1_by_seq" to true in 
+    contractor_mobilization_delay_seismic (default false, see Building.con_delay_rc1_by_seq), in which case the 
+    sequences with a maximum repair class of 1 use the rc1 parameters.
+    """
 
-    # Get distribution
-    con_delay_distribution = con_delay_params["distribution"]
+    max_nonstruct_rc = np.asarray(max_nonstruct_rc)
+    n_sequences = max_nonstruct_rc.shape[-1]
 
-    # Loop over all sequences
-    for seq_index in range(n_sequences):
+    # no delay if no nonstructural damage
+    sampled = max_nonstruct_rc != 0
 
-        # no delay if no nonstructural damage
-        if max_nonstruct_rc[seq_index] == 0:
-            delays[seq_index] = 0.0
-        else:
-            # different parameters for different repair classes
-            if max_nonstruct_rc == 1:
+    # different parameters for different repair classes, the rc1 parameters for the sequences with a maximum repair 
+    # class of 1. The loop version compared the whole list of repair classes to 1, which is never true, so by default 
+    # (con_delay_rc1_by_seq off) the rc23 parameters are used for every sequence to keep the seeded results unchanged
+    rc1 = (max_nonstruct_rc == 1) & building.con_delay_rc1_by_seq
 
-                # theta = params[1][seq_index,1]
-                # sigma = params[1][seq_index,2]
-                theta = con_delay_params["rc1"]["theta_by_seq"][seq_index]
-                sigma = con_delay_params["rc1"]["sigma_by_seq"][seq_index]
-            else:
-                # theta = params[2][seq_index,1]
-                # sigma = params[2][seq_index,2]
-                theta = con_delay_params["rc23"]["theta_by_seq"][seq_index]
-                sigma = con_delay_params["rc23"]["sigma_by_seq"][seq_index]
+    theta = np.where(rc1, building.con_delay_theta_by_seq[0, :n_sequences], building.con_delay_theta_by_seq[1, :n_sequences])
+    sigma = np.where(rc1, building.con_delay_sigma_by_seq[0, :n_sequences], building.con_delay_sigma_by_seq[1, :n_sequences])
 
-            # sample delay
-            sample_delay = sample_dist(con_delay_distribution, theta, sigma)
-            delays[seq_index] = sample_delay
+    # sample delays
+    delays = np.zeros(max_nonstruct_rc.shape)
+    delays[sampled] = sample_dist_array(building.con_delay_params["distribution"], theta[sampled], sigma[sampled])
 
     return delays
 
 
 def get_longlead_by_seq(building : Building,
                         components_lib : ComponentsLibrary,
-                        component_qty : Dict[str,float]) -> np.ndarray :
+                        component_qty : Dict[str,float],
+                        n_realizations : Optional[int]=None) -> np.ndarray :
 
-    # Get the number of sequences
-    n_sequences = building.n_sequences
-    
-    # Initialize result
-    longlead_by_seq = np.zeros(n_sequences)
-    
-    # Get the damage states across all floors
-    damage_states_all_floors = building.damage_by_component_all_DS
-    
-    # Get long lead time risk parameters
-    threshold = building.long_lead_threshold
-    distribution = building.long_lead_distribution
-    beta = building.long_lead_beta
-    
-    # loop over all the components with damage
-    # for a given component pull the NISTR tag and damage state data
-    for nistr, comp_damage in damage_states_all_floors.items() :
-
-        component = components_lib[nistr]
-     
-        # Get long lead time for component (has units of days)
-        if "long_lead" in component:
-            longlead_comp = component["long_lead"]
-        else:
-            longlead_comp = [0. for ds_index in range(component["n_ds"]+1)]
-        
-        # find the largest damage state with a number of associated components above the long_lead threshold        
-        DS_index = None
-        for i in range(len(damage_states_all_floors[nistr])) :
-            comp_quantity = component_qty[nistr]
-            if damage_states_all_floors[nistr][i] > threshold * comp_quantity:
-                DS_index = i
-
-        if DS_index == None :
-            longlead_component = 0.0
-        else:
-            # This check is just here to account for long_lead entries that appear to have been put in erroneously
-            if DS_index >= len(longlead_comp) :
-                longlead_component = 0.0
-            else:
-                longlead_component = sample_dist(distribution, longlead_comp[DS_index], beta)
-        
-        # compare to current sequence maximum, and replace if larger
-        sequence_index = int(component["seq"][0]) 
-        longlead_by_seq[sequence_index] = max(longlead_by_seq[sequence_index], longlead_component)
+    """
+    Samples the long lead time of every sequence, i.e., the largest long lead time of its components
+
+    One sample is drawn per component with a long lead time, in the order of damage_by_component_all_DS. With 
+    n_realizations, the long lead times of n_realizations consecutive realizations are sampled at once.
 
+    Returns:
+    np.ndarray: long lead time of each sequence (days), [n_sequences] or [n_realizations x n_sequences]
+    """
+
+    # Get the components with a long lead time and their medians, computed once by the prepare stage
+    longlead_inputs = building.longlead_inputs or get_longlead_inputs(building=building, 
+                                                                      components_lib=components_lib, 
+                                                                      component_qty=component_qty)
+
+    shape = (building.n_sequences,) if n_realizations is None else (n_realizations, building.n_sequences)
+
+    # Sample the long lead times in one go
+    longlead_component = sample_dist_array(building.long_lead_distribution, 
+                                           longlead_inputs["long_lead"], 
+                                           building.long_lead_beta, 
+                                           size=shape[:-1] + longlead_inputs["long_lead"].shape)
+
+    # Get the maximum of each sequence
+    n_rows = int(np.prod(shape[:-1]))
+    longlead_by_seq = np.zeros((n_rows, shape[-1]))
+    np.maximum.at(longlead_by_seq, 
+                  (np.arange(n_rows)[:, None], longlead_inputs["seq"]), 
+                  longlead_component.reshape(n_rows, len(longlead_inputs["seq"])))
+
+    longlead_by_seq = longlead_by_seq.reshape(shape)
 
     return longlead_by_seq
 
 
+def get_longlead_inputs(building : Building,
+                        components_lib : ComponentsLibrary,
+                        component_qty : Dict[str,float]) -> Dict[str,np.ndarray] :
+
+    """
+    Gets the components for which a long lead time is sampled, in the order of damage_by_component_all_DS
+
+    Returns:
+    dict: the sequence and the median long lead time (days) of each of these components
+    """
+
+    # Get the damage states across all floors [nComponents x nTotalFloor]
+    damage_states_all_floors = building.damage_by_component_all_DS
+    NISTRs = list(damage_states_all_floors.keys())
+    damage = np.array(list(damage_states_all_floors.values()), dtype=np.float64).reshape(len(NISTRs), building.nTotalFloor)
+
+    ids = components_lib.component_ids(NISTRs)
+
+    # find the largest damage state with a number of associated components above the long_lead threshold        
+    comp_quantity = np.array([component_qty[nistr] for nistr in NISTRs], dtype=np.float64)
+    above_threshold = damage > building.long_lead_threshold * comp_quantity[:, None]
+    has_DS_index = above_threshold.any(axis=1)
+    DS_index = damage.shape[1] - 1 - np.argmax(above_threshold[:, ::-1], axis=1)
+
+    # Get long lead time for component (has units of days), the components without one have zeros for n_ds + 1 damage states
+    has_long_lead = components_lib.has_long_lead[ids]
+    longlead_len = np.where(has_long_lead, components_lib.long_lead_len[ids], components_lib.n_ds[ids] + 1)
+
+    # The length check is just here to account for long_lead entries that appear to have been put in erroneously
+    sampled = has_DS_index & (DS_index < longlead_len)
+
+    long_lead = np.zeros(len(NISTRs))
+    with_long_lead = sampled & has_long_lead
+    long_lead[with_long_lead] = components_lib.long_lead[ids[with_long_lead], DS_index[with_long_lead]]
+
+    return {"seq" : components_lib.seq[ids[sampled], 0],
+            "long_lead" : long_lead[sampled]}
+
+
 def get_max_delay(impeding_delays : Dict[str,float]) -> float :
 
     # Calculate each delay path
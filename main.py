@@ -1,7 +1,10 @@
 import json, time, argparse
 from go_redi import go_redi
+from parallel import go_redi_parallel
 from utils.file_utils import write_results
-from utils.stat_utils import set_seed
+from utils.stat_utils import enable_sampling_counters, get_sampling_report
+from utils.timing_utils import enable_timing, timed, get_timing_report, profiled
+from building import LazyComponentsLibrary
 from pathlib import Path
 
 def main(args):
@@ -10,9 +13,14 @@ def main(args):
     path_components=args.c
     burn_in=args.b
     seed=args.s
-    seed=args.s
+    n_realizations=args.n
+    n_workers=args.w
     out_path=args.r
 
+    # record the time spent in each stage of the analysis, and the calls of the sampling functions
+    enable_timing(args.t)
+    enable_sampling_counters(args.k)
+
     # open the asset JSON file
     with open(path_building) as f:
         
@@ -21,7 +29,10 @@ def main(args):
 
     # load components if provided
     component_data = None
-    if path_components :
+    if args.l :
+        # only the components of the building are read from the file
+        component_data = LazyComponentsLibrary(json_path=path_components or Path(__file__).resolve().parent/'data/components_library.json')
+    elif path_components :
         with open(path_components) as f:
             # load the JSON data as a list
             component_data = json.loads(f.read())
@@ -34,17 +45,36 @@ def main(args):
         # res = go_redi(building_dict=building_data, components_lib_dict=component_data, seed=0,burn_in=0)
         # print('Total downtime :',res['building_total_downtime'],'\n')
 
-    # run the REDi engine
-    res = go_redi(building_dict=building_data, components_lib_dict=component_data, seed=seed,burn_in=burn_in)
+    # run the REDi engine, under a profiler if requested
+    with profiled(args.p) :
+        if n_realizations > 1 :
+            res = go_redi_parallel(building_dicts=[building_data], n_realizations=n_realizations, components_lib_dict=component_data, seed=seed, burn_in=burn_in, n_workers=n_workers)[0]
+
+            print('Mean total downtime :',res['building_total_downtime'].mean(axis=0),'\n')
+        else :
+            res = go_redi(building_dict=building_data, components_lib_dict=component_data, seed=seed,burn_in=burn_in)
 
-    print('Total downtime :',res['building_total_downtime'],'\n')
+            print('Total downtime :',res['building_total_downtime'],'\n')
 
     end_time = time.time()
     elapsed_time = end_time - start_time
 
     print("Elapsed time: ", elapsed_time)
 
-    write_results(res=res, out_path=out_path)
+    with timed("write_results") :
+        write_results(res=res, out_path=out_path)
+
+    if args.t :
+        print()
+        print(get_timing_report(total_time=time.time() - start_time))
+        if n_realizations > 1 and n_workers > 1 :
+            print("(only the stages run in this process are timed, use -w 1 to time the realizations)")
+
+    if args.k :
+        print()
+        print(get_sampling_report())
+        if n_realizations > 1 and n_workers > 1 :
+            print("(only the calls made in this process are counted, use -w 1 to count the calls of the realizations)")
 
 
 if __name__ == "__main__":
@@ -54,6 +84,12 @@ if __name__ == "__main__":
     parser.add_argument('-c', type=str, default=None, help='Path to the components JSON file [str] (optional - REDi will use built-in FEMA P-58-2 component library if blank)')
     parser.add_argument('-r', type=str, default=None, help='Path of the results file (include the .json suffix in path)')
     parser.add_argument('-s', type=int, default=0, help='Seed for the random number generator, for deterministic output [int] (optional - leave blank for stochastic output)')
+    parser.add_argument('-n', type=int, default=1, help='Number of realizations to run [int] (optional - results are stacked by realization if more than one)')
+    parser.add_argument('-w', type=int, default=1, help='Number of worker processes used to run the realizations [int] (optional - results do not depend on the number of workers)')
+    parser.add_argument('-l', action='store_true', help='Load the components lazily, i.e., only read the components of the building from the components JSON file (optional)')
+    parser.add_argument('-t', action='store_true', help='Print the time spent in each stage of the analysis (optional)')
+    parser.add_argument('-k', action='store_true', help='Print the number of calls of the sampling functions by distribution and calling site (optional)')
+    parser.add_argument('-p', type=str, default=None, choices=['cprofile', 'pyinstrument'], help='Profile the run with cProfile or pyinstrument (optional - pyinstrument has to be installed)')
     parser.add_argument('-b', type=int, default=0, help='Burn-in number, i.e., how many times to generate and discard random numbers at random number generator initialization [int] (optional - mainly for testing purposes)')
 
     args = parser.parse_args()
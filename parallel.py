@@ -0,0 +1,144 @@
+import os, sys, math
+
+file_dir = os.path.dirname(__file__)
+sys.path.append(file_dir)
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Any, Optional, Tuple
+
+import numpy as np
+
+from building import Building, ComponentsLibrary
+from go_redi import load_components_library, prepare_building, run_realizations
+from utils.stat_utils import new_entropy
+
+# Components library of a worker process, set once by _init_worker
+_worker_components_lib = None
+
+# Prepared buildings of a worker process by building index, so that the prepare stage of a building runs once per 
+# worker even when its realizations are split into several chunks
+_worker_buildings : Dict[int, Building] = {}
+
+
+def go_redi_parallel(building_dicts : List[dict],
+                     n_realizations : int = 1,
+                     components_lib_dict : Optional[dict]=None,
+                     seed=None,
+                     burn_in=None,
+                     n_workers : Optional[int]=None,
+                     chunk_size : Optional[int]=None) -> List[Dict[str,Any]] :
+
+    """
+    Runs n_realizations realizations of REDi for every building on a pool of worker processes
+
+    The components library is sent to each worker once, when the worker starts. The realizations of every
+    building are split into chunks of chunk_size realizations and the chunks are run concurrently. Building i
+    uses the seed [seed, i], and every realization its own stream spawned from it (see get_realization_pool),
+    so the results of building i are identical to go_redi_batch(building_dicts[i], n_realizations, seed=[seed, i])
+    regardless of the number of workers and the chunk size.
+
+    Args:
+    building_dicts (list): the building inputs
+    n_realizations (int): number of realizations to run for each building
+    components_lib_dict (dict): components library (optional - the built-in library is used if None, a ComponentsLibrary such as a LazyComponentsLibrary is used as is)
+    seed (int): seed of the run (optional - fresh entropy is used if not provided)
+    burn_in (int): number of random numbers to discard at the start of every realization stream
+    n_workers (int): number of worker processes (optional - defaults to the number of CPUs, 1 runs in this process)
+    chunk_size (int): number of realizations per task (optional - defaults to about 4 tasks per worker)
+
+    Returns:
+    list: the results of each building, in the same order as building_dicts and stacked by realization as in go_redi_batch
+    """
+
+    if n_realizations < 1 :
+        raise ValueError(f"Error, the number of realizations must be at least 1, {n_realizations} was provided")
+
+    n_workers = n_workers or os.cpu_count() or 1
+    n_buildings = len(building_dicts)
+
+    if chunk_size is None :
+        chunk_size = max(1, math.ceil(n_buildings * n_realizations / (4 * n_workers)))
+
+    # Entropy of the run, the seed of each building is spawned from it
+    entropy = seed if seed else new_entropy()
+
+    # Split the realizations of every building into chunks
+    tasks = []
+    for building_index, building_dict in enumerate(building_dicts) :
+        for start in range(0, n_realizations, chunk_size) :
+            realizations = list(range(start, min(start + chunk_size, n_realizations)))
+            tasks.append((building_index, building_dict, realizations, [entropy, building_index], burn_in))
+
+    components_lib = load_components_library(components_lib_dict, 
+                                             NISTRs={NISTR for building_dict in building_dicts for NISTR in building_dict['component_damage']})
+
+    if n_workers == 1 :
+        _init_worker(components_lib)
+        chunks = [_run_chunk(task) for task in tasks]
+    else :
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 initializer=_init_worker,
+                                 initargs=(components_lib,)) as executor :
+            chunks = list(executor.map(_run_chunk, tasks))
+
+    # Merge the chunks, in the order of the tasks, i.e., by building then by realization
+    results_by_building : List[List[Dict[str,Any]]] = [[] for _ in range(n_buildings)]
+    for building_index, chunk in chunks :
+        results_by_building[building_index].append(chunk)
+
+    return [_merge_chunks(chunk_list, [entropy, building_index]) for building_index, chunk_list in enumerate(results_by_building)]
+
+
+def _init_worker(components_lib : ComponentsLibrary) :
+
+    global _worker_components_lib
+
+    # A lazy library only parses, in each worker, the components of the buildings it runs
+    _worker_components_lib = components_lib
+
+    _worker_buildings.clear()
+
+
+def _run_chunk(task : Tuple[int, dict, List[int], List[int], Optional[int]]) -> Tuple[int, Dict[str,Any]] :
+
+    building_index, building_dict, realizations, entropy, burn_in = task
+
+    # Parse and prepare the building the first time this worker runs one of its chunks
+    building = _worker_buildings.get(building_index)
+    if building is None :
+        building = Building(building_dict=building_dict)
+        prepare_building(building=building, components_lib=_worker_components_lib)
+        _worker_buildings[building_index] = building
+
+    results = run_realizations(building=building,
+                               components_lib=_worker_components_lib,
+                               realizations=realizations,
+                               entropy=entropy,
+                               burn_in=burn_in)
+
+    # Building-level results, the same for every chunk
+    results["components"] = list(building.damage_by_component_all_floors.keys())
+    results["damage_by_component_all_DS"] = building.damage_by_component_all_DS
+    results["component_qty"] = building.component_qty
+
+    return building_index, results
+
+
+def _merge_chunks(chunks : List[Dict[str,Any]],
+                  entropy : List[int]) -> Dict[str,Any] :
+
+    first = chunks[0]
+
+    merged : Dict[str,Any] = {
+        "seed" : entropy,
+        "components" : first["components"],
+        "damage_by_component_all_DS" : first["damage_by_component_all_DS"],
+        "component_qty" : first["component_qty"],
+    }
+
+    for key in ["realizations", "repair_class", "max_delay", "struct_repairs", "total_span", "building_total_downtime"] :
+        merged[key] = np.concatenate([chunk[key] for chunk in chunks])
+
+    merged["impeding_delays"] = {key: np.concatenate([chunk["impeding_delays"][key] for chunk in chunks]) for key in first["impeding_delays"]}
+
+    return merged
@@ -2,14 +2,18 @@ import numpy as np
 from typing import List, Dict, Any
 
 from building import Building, ComponentsLibrary
-from utils.stat_utils import sample_dist, deepArray2matrix
+from utils.stat_utils import sample_dist_array, deepArray2matrix
+from utils.timing_utils import timed_stage
 from repair_schedules.scheduling_optimization.get_optimized_repair_schedule import get_optimized_repair_schedule_diff_start
+from repair_schedules.scheduling_optimization.allocation_timeline import AllocationTimeline
 
+@timed_stage("get_repair_schedule")
 def get_repair_schedule(building : Building,
                         components_lib : ComponentsLibrary, 
                         struc_repair_days : np.ndarray,
                         nonstruct_contractor_delays : np.ndarray,
-                        max_workers : float) -> List[Dict[str,Any]] :
+                        max_workers : float,
+                        record_allocation : bool=True) -> List[Dict[str,Any]] :
     
     n_non_struc_sequence =  building.n_non_struc_sequence
     n_repair_goal = building.n_repair_goal
@@ -44,7 +48,8 @@ def get_repair_schedule(building : Building,
                                                 constraint=constraint,
                                                 n_non_struc_sequence=n_non_struc_sequence,
                                                 n_repair_goal=n_repair_goal,
-                                                n_sequence=n_sequence)
+                                                n_sequence=n_sequence,
+                                                record_allocation=record_allocation)
 
 
 def get_repair_schedule_unit_realization(delay : List[float],
@@ -57,7 +62,8 @@ def get_repair_schedule_unit_realization(delay : List[float],
                                          constraint : np.ndarray,
                                          n_non_struc_sequence : int,
                                          n_repair_goal : int,
-                                         n_sequence : int) -> List[Dict[str,Any]]:
+                                         n_sequence : int,
+                                         record_allocation : bool=True) -> List[Dict[str,Any]]:
                                              
     sequence_demand_by_goal = np.zeros((n_repair_goal,nTotalFloor,n_sequence-1))
     for goal in range(n_repair_goal) :
@@ -85,7 +91,8 @@ def get_repair_schedule_unit_realization(delay : List[float],
                                                    struct_days=struct_d,
                                                    constraint=constraint,
                                                    struc_repair_days=struc_repair_d,
-                                                   n_non_struc_sequence=n_non_struc_sequence)
+                                                   n_non_struc_sequence=n_non_struc_sequence,
+                                                   record_allocation=record_allocation)
                                   
     
         res.append(unit_goal)
@@ -101,7 +108,8 @@ def get_repair_schedule_unit_goal(nonstructural_delays :np.ndarray,
                                   struct_days : float,
                                   constraint : np.ndarray,
                                   struc_repair_days : float,
-                                  n_non_struc_sequence : int) -> Dict[str,Any] :
+                                  n_non_struc_sequence : int,
+                                  record_allocation : bool=True) -> Dict[str,Any] :
                                   
     # seq_with_demand = [i+1 for i in range(len(sequence_demand_by_goal_matrixed)) if any([sequence_demand_by_goal_matrixed[i][j][k] > 0 for j in range(1, n_non_struc_sequence) for k in range(nTotalFloor)])]
     # seq_with_demand =  np.where(sequence_demand_by_goal_matrixed > 0)[0]
@@ -123,7 +131,7 @@ def get_repair_schedule_unit_goal(nonstructural_delays :np.ndarray,
         
 
     if len(seq_with_demand) == 0:
-        return {"total_span": 0, "span_by_seq": reshape_by_floor([0 for i in range(nTotalFloor*n_non_struc_sequence)],nTotalFloor), "allocation": {}, "ends":[], "starts":[], "struct_repairs": struc_repair_days, "ready": nonstructural_delays}
+        return {"total_span": 0, "span_by_seq": reshape_by_floor([0 for i in range(nTotalFloor*n_non_struc_sequence)],nTotalFloor), "allocation": AllocationTimeline(nTotalFloor*n_non_struc_sequence, shape=(nTotalFloor, n_non_struc_sequence), order='F'), "ends":[], "starts":[], "struct_repairs": struc_repair_days, "ready": nonstructural_delays}
         
     # sequences_exceeding_struct = [i for i in range(len(nonstructural_delays)) if nonstructural_delays[i] > struct_days]
     sequences_exceeding_struct = []
@@ -147,7 +155,8 @@ def get_repair_schedule_unit_goal(nonstructural_delays :np.ndarray,
                                                     ready=ready,
                                                     struc_repair_days=struc_repair_days,
                                                     n_non_struc_sequence=n_non_struc_sequence,
-                                                    now=struct_days)
+                                                    now=struct_days,
+                                                    record_allocation=record_allocation)
         
 
 def adjust_capacity(capacity : np.ndarray, 
@@ -155,40 +164,31 @@ def adjust_capacity(capacity : np.ndarray,
                     constraint : np.ndarray,
                     n_non_struc_sequence : int) -> np.ndarray :
     
-    # Loop over all sequences
-    for seq in range(n_non_struc_sequence) :
+    """
+    Limits the workers of every sequence to the building-level constraint, i.e., if the capacity of all the floors 
+    with worker demand exceeds constraint, it is evenly split among those floors
 
-        # Initialize the floors that have worker demand
-        floors_w_demand = []
+    Works on a single realization ([nTotalFloor x n_non_struc_sequence] capacity and [n_non_struc_sequence] constraint) 
+    or on stacked realizations ([... x nTotalFloor x n_non_struc_sequence] capacity and [... x n_non_struc_sequence] constraint).
+    The capacity is not modified, the adjusted capacity is returned.
+    """
 
-        # Initialize the total worker demand for this sequence
-        worker_demand = 0.0
+    capacity = np.asarray(capacity, dtype=np.float64)[..., :nTotalFloor, :n_non_struc_sequence]
+    constraint = np.asarray(constraint, dtype=np.float64)[..., :n_non_struc_sequence]
 
-        # Loop over all floors
-        for floor_index in range(nTotalFloor) :
+    # Get the floors that have worker demand
+    floors_w_demand = capacity > 0.0
 
-            # If the floor has worker demand
-            if capacity[floor_index][seq] > 0.0:
-                
-                # Add to the floors with demand
-                floors_w_demand.append(floor_index)
+    # Get the total worker demand of each sequence, summed floor by floor
+    worker_demand = np.where(floors_w_demand, capacity, 0.0).sum(axis=-2)
 
-                # Add to the total worker demand
-                worker_demand += capacity[floor_index][seq]
+    # Calculate new worker capacity per floor, where the total worker demand is larger than the building-level constraint
+    exceeds = worker_demand > constraint
+    with np.errstate(divide='ignore', invalid='ignore') :
+        new_capacity_per_floor = constraint / np.count_nonzero(floors_w_demand, axis=-2)
 
-        # If the total worker demand is larger than the building-level constraint...
-        if worker_demand > constraint[seq] :
-
-            # Calculate new worker capacity per floor
-            new_capacity_per_floor = constraint[seq] / float(len(floors_w_demand))
-
-            # Assign new capacity per floor to each floor with demand
-            for floor_index in floors_w_demand:
-
-                capacity[floor_index][seq] = new_capacity_per_floor
-                
-    # Need to store as matrix in order for synchronous_alloc to work
-    return deepArray2matrix(capacity, nTotalFloor, n_non_struc_sequence)
+    # Assign new capacity per floor to each floor with demand
+    return np.where(floors_w_demand & exceeds[..., None, :], new_capacity_per_floor[..., None, :], capacity)
 
 
 def get_worker_capacity(building : Building, 
@@ -215,52 +215,56 @@ def get_recommended_workers(building : Building,
                             nTotalFloor : int,
                             n_non_struc_sequence : int) -> np.ndarray :
 
-    # Get data from risk parameters    
-    nwork_perfloor_divider = building.nwork_perfloor_divider
-    recommended_workers_floor_area = [np.zeros(n_non_struc_sequence) for _ in range(nTotalFloor)]
-    for floor in range(nTotalFloor) :
-        for seq in range(n_non_struc_sequence) :
-            recommended_workers_floor_area[floor][seq] = floor_areas[floor] / nwork_perfloor_divider[seq] 
-    
-    # Get the risk parameters
-    nworkers_recommended_mean = building.nworkers_recommended_mean
-    recommended_workers_per_comp = [nworkers_recommended_mean[seq] for seq in range(n_non_struc_sequence)]
-    recommended_workers_distribution = building.recommended_workers_distribution
-    recommended_workers_beta = building.recommended_workers_beta
+    # Get the mean recommended workers, computed once by the prepare stage
+    recommended_workers_mean_nonstruct = building.recommended_workers_mean
+    if recommended_workers_mean_nonstruct is None :
+        recommended_workers_mean_nonstruct = get_recommended_workers_mean(building=building, 
+                                                                          components_lib=components_lib,
+                                                                          floor_areas=floor_areas, 
+                                                                          damage_qty=damage_qty, 
+                                                                          nTotalFloor=nTotalFloor,
+                                                                          n_non_struc_sequence=n_non_struc_sequence)
 
-    # Initialize result (total number of workers based on the number of damaged components)
-    recommended_workers_damaged_comp = [np.zeros(n_non_struc_sequence) for _ in range(nTotalFloor)]
+    # Sample the recommended workers for every floor and sequence in one go
+    recommended_workers = sample_dist_array(building.recommended_workers_distribution, 
+                                            recommended_workers_mean_nonstruct, 
+                                            building.recommended_workers_beta)
 
-    # Loop over all components to get damaged quantity in each sequence
-    for  NISTR, damage in damage_qty.items():
 
-        # Get the sequence from the component
-        seq = components_lib[NISTR]["seq"][0]
+    # return recommended_wodrkers
+    return recommended_workers
 
-        # Only proceed if a nonstructural component (i.e. seq > 0)
-        if seq > 0:
 
-            # Add workers to each floor based on the number of damaged components
-            for floor in range(nTotalFloor):
-                recommended_workers_damaged_comp[floor-1][seq-1] += recommended_workers_per_comp[seq-1] * damage[floor-1]
+def get_recommended_workers_mean(building : Building, 
+                                 components_lib : ComponentsLibrary, 
+                                 floor_areas : List[float], 
+                                 damage_qty : Dict[str,Any], 
+                                 nTotalFloor : int,
+                                 n_non_struc_sequence : int) -> np.ndarray :
 
-    # Finalize the mean recommended workers in each sequence as the minimum of the floor area estimate and the damaged components estimate
-    recommended_workers_mean_nonstruct = [np.zeros(n_non_struc_sequence) for _ in range(nTotalFloor)]
-    for floor in range(nTotalFloor) :
-        for seq in range(n_non_struc_sequence) :
-            recommended_workers_mean_nonstruct[floor][seq] = min(recommended_workers_floor_area[floor][seq], recommended_workers_damaged_comp[floor][seq])
+    # Get data from risk parameters, the workers based on the floor area [nTotalFloor x n_non_struc_sequence]
+    nwork_perfloor_divider = np.asarray(building.nwork_perfloor_divider[:n_non_struc_sequence], dtype=np.float64)
+    recommended_workers_floor_area = np.asarray(floor_areas[:nTotalFloor], dtype=np.float64)[:, None] / nwork_perfloor_divider
     
-    recommended_workers = np.array([np.zeros(n_non_struc_sequence) for _ in range(nTotalFloor)])
-    for floor in range(nTotalFloor) :
-        for seq in range(n_non_struc_sequence) :
-            var1 = recommended_workers_mean_nonstruct[floor][seq]
-            var2 = recommended_workers_beta
-            sample = sample_dist(recommended_workers_distribution, var1, var2)
-            recommended_workers[floor][seq] =sample
+    # Get the risk parameters
+    recommended_workers_per_comp = np.asarray(building.nworkers_recommended_mean[:n_non_struc_sequence], dtype=np.float64)
 
+    # Get the sequence of every component, only nonstructural components (i.e. seq > 0) add workers
+    NISTRs = list(damage_qty.keys())
+    ids = components_lib.component_ids(NISTRs)
+    seq = components_lib.seq[ids, 0] if NISTRs else np.zeros(0, dtype=int)
+    nonstruct = seq > 0
 
-    # return recommended_wodrkers
-    return recommended_workers
+    # Damaged quantity of every nonstructural component on each floor [nComponents x nTotalFloor]
+    damage = np.array([damage_qty[NISTR] for NISTR, is_nonstruct in zip(NISTRs, nonstruct) if is_nonstruct], dtype=np.float64).reshape(-1, nTotalFloor)
+    seq = seq[nonstruct] - 1
+
+    # Add workers to each floor based on the number of damaged components, summed in the order of the components
+    recommended_workers_damaged_comp = np.zeros((n_non_struc_sequence, nTotalFloor))
+    np.add.at(recommended_workers_damaged_comp, seq, recommended_workers_per_comp[seq][:, None] * damage)
+
+    # Finalize the mean recommended workers in each sequence as the minimum of the floor area estimate and the damaged components estimate
+    return np.minimum(recommended_workers_floor_area, recommended_workers_damaged_comp.T)
 
 
 def get_worker_constraint_mean(building : Building) -> List[int]:
@@ -280,13 +284,16 @@ def get_worker_constraint_mean(building : Building) -> List[int]:
 
 def get_constrained_workers(building : Building) -> np.ndarray :
     
-    mean = get_worker_constraint_mean(building=building)
+    # Get the mean, computed once by the prepare stage
+    mean = building.worker_constraint_mean
+    if mean is None :
+        mean = get_worker_constraint_mean(building=building)
 
     # Get risk parameters
     distribution = building.workers_cap_distribution
     beta = building.workers_cap_beta
 
-    return np.array([sample_dist(distribution, m, beta) for m in mean])
+    return sample_dist_array(distribution, mean, beta)
 
 
 def reshape_by_floor(lst, n_floor) :
@@ -0,0 +1,152 @@
+import numpy as np
+from typing import List, Optional, Tuple
+
+
+class AllocationTimeline():
+
+    """
+    History of the workers assigned to every floor and sequence during a repair schedule
+
+    Only the cells that change at each event are stored, i.e., the sorted event times and, for every event, the
+    indices of the changed cells and their new number of workers. Storing the new values instead of the
+    differences makes the reconstructed states exactly the recorded ones. The changed cells of an event are stored
+    as int32 indices, or as a packed bit mask when that is smaller (e.g. when the workers are re-allocated to most
+    of the cells).
+
+    The cells are stored flat, shape and order give how a flat state is reshaped (e.g. (nFloor, n_non_struc_sequence)
+    in Fortran order for the flattened repair schedule).
+    """
+
+    def __init__(self,
+                 n_cells : int,
+                 shape : Optional[Tuple[int,...]]=None,
+                 order : str='C') :
+
+        self.n_cells = n_cells
+        self.shape = shape if shape is not None else (n_cells,)
+        self.order = order
+
+        # Event times and, for each event, the changed cells and their new values
+        self._times : List[float] = []
+        self._indices : List[np.ndarray] = []
+        self._values : List[np.ndarray] = []
+
+        # State after the last event
+        self._state = np.zeros(n_cells)
+
+
+    def record(self,
+               time : float,
+               workers_assigned : np.ndarray) :
+
+        # Get the cells that changed since the last event
+        changed = np.where(workers_assigned != self._state)[0]
+
+        if len(changed) == 0 :
+            return
+
+        if self._times and time < self._times[-1] :
+            raise ValueError(f"Error, the events must be recorded in time order, {time} is before {self._times[-1]}")
+
+        values = workers_assigned[changed]
+        self._state[changed] = values
+
+        # Several events at the same time are merged, the last one gives the state at that time
+        if self._times and time == self._times[-1] :
+            changed = np.union1d(self._changed_cells(-1), changed)
+            self._indices[-1] = self._encode(changed)
+            self._values[-1] = self._state[changed]
+            return
+
+        self._times.append(time)
+        self._indices.append(self._encode(changed))
+        self._values.append(values)
+
+
+    def with_shape(self,
+                   shape : Tuple[int,...],
+                   order : str='C') -> "AllocationTimeline" :
+
+        if int(np.prod(shape)) != self.n_cells :
+            raise ValueError(f"Error, cannot reshape {self.n_cells} cells to {shape}")
+
+        # Share the recorded events, only the shape of the states changes
+        timeline = AllocationTimeline(self.n_cells, shape=shape, order=order)
+        timeline._times, timeline._indices, timeline._values = self._times, self._indices, self._values
+        timeline._state = self._state
+
+        return timeline
+
+
+    @property
+    def times(self) -> np.ndarray :
+        return np.array(self._times, dtype=np.float64)
+
+
+    @property
+    def nbytes(self) -> int :
+        return sum(indices.nbytes + values.nbytes for indices, values in zip(self._indices, self._values))
+
+
+    def __len__(self) -> int :
+        return len(self._times)
+
+
+    def state_at(self,
+                 time : float) -> np.ndarray :
+
+        """
+        Returns the workers assigned to each cell at a given time, i.e., after every event up to and including time
+        """
+
+        n_events = int(np.searchsorted(self._times, time, side='right'))
+
+        state = np.zeros(self.n_cells)
+        for event in range(n_events) :
+            state[self._changed_cells(event)] = self._values[event]
+
+        return self._reshape(state)
+
+
+    def to_dense(self) -> Tuple[np.ndarray, np.ndarray] :
+
+        """
+        Returns the event times and the workers assigned after each event, i.e., an array of shape (nEvents, *shape)
+        """
+
+        dense = np.zeros((len(self._times), *self.shape))
+
+        state = np.zeros(self.n_cells)
+        for event in range(len(self._times)) :
+            state[self._changed_cells(event)] = self._values[event]
+            dense[event] = self._reshape(state)
+
+        return self.times, dense
+
+
+    def _encode(self,
+                changed : np.ndarray) -> np.ndarray :
+
+        # Indices take 4 bytes per changed cell, the bit mask 1 bit per cell
+        if 4 * len(changed) > (self.n_cells + 7) // 8 :
+            mask = np.zeros(self.n_cells, dtype=bool)
+            mask[changed] = True
+            return np.packbits(mask)
+
+        return changed.astype(np.int32)
+
+
+    def _changed_cells(self,
+                       event : int) -> np.ndarray :
+
+        encoded = self._indices[event]
+
+        if encoded.dtype == np.uint8 :
+            return np.where(np.unpackbits(encoded, count=self.n_cells))[0]
+
+        return encoded
+
+
+    def _reshape(self,
+                 state : np.ndarray) -> np.ndarray :
+        return np.reshape(state, self.shape, order=self.order)
@@ -11,13 +11,15 @@ def get_optimized_repair_schedule_diff_start(demand : np.ndarray,
                                              ready : np.ndarray,
                                              struc_repair_days : float,
                                              n_non_struc_sequence : int,
-                                             now : float=0.0) -> Dict[str,Any] :
+                                             now : float=0.0,
+                                             record_allocation : bool=True) -> Dict[str,Any] :
                                              
     r = synchronous_alloc(demand = demand.T.flatten(), 
                           constraint = capacity.T.flatten(), 
                           nWorker=nWorker, 
                           ready=ready.T.flatten(),
-                          now=now)
+                          now=now,
+                          record_allocation=record_allocation)
         
     
     r["starts"] = reshape_by_floor(list=r["starts"],
@@ -32,13 +34,8 @@ def get_optimized_repair_schedule_diff_start(demand : np.ndarray,
                                         nFloor=nFloor,
                                         n_non_struc_sequence=n_non_struc_sequence)
     
-    allocation = dict()
-    for original_alloc in r["allocation"].items():
-        allocation[original_alloc[0]] = reshape_by_floor(list = original_alloc[1],
-                                                         nFloor=nFloor,
-                                                         n_non_struc_sequence=n_non_struc_sequence)
-        
-    r["allocation"] = allocation
+    # The cells of the allocation timeline are flattened in the same order
+    r["allocation"] = r["allocation"].with_shape((nFloor, n_non_struc_sequence), order='F')
     r["struct_repairs"] = struc_repair_days
     
     assert "allocation" in r.keys()
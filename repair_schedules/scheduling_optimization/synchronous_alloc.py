@@ -1,11 +1,17 @@
+import heapq
 import numpy as np
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 
+from repair_schedules.scheduling_optimization.allocation_timeline import AllocationTimeline
+from utils.timing_utils import timed_stage
+
+@timed_stage("synchronous_alloc")
 def synchronous_alloc(demand : np.ndarray, 
                       constraint : np.ndarray, 
                       nWorker : float, 
                       ready : np.ndarray,
-                      now : float = 0.0) -> Dict[Any,Any] :
+                      now : float = 0.0,
+                      record_allocation : bool = True) -> Dict[Any,Any] :
    
     N = len(demand)
     demand, constraint, ready = demand.copy(), constraint.copy(), ready.copy()
@@ -13,7 +19,8 @@ def synchronous_alloc(demand : np.ndarray,
     workers_assigned = np.zeros(N).astype(np.float64) # vary in each step
     starts = np.full(N, -1.0) # initialized as [-1]
     ends = time2finish.copy() # initialized as [Inf]
-    workers_assigned_all_step : Dict[Any,Any] = {}
+    # Workers assigned at every step, only recorded if requested
+    workers_assigned_all_step = AllocationTimeline(N)
     constraint = constraint.astype(np.float64)
     demand = demand.astype(np.float64)
     capacity = constraint.copy()
@@ -26,7 +33,7 @@ def synchronous_alloc(demand : np.ndarray,
                                              ends=ends,  
                                              workers_assigned=workers_assigned,  
                                              nWorker=nWorker, 
-                                             workers_assigned_all_step=workers_assigned_all_step, 
+                                             workers_assigned_all_step=workers_assigned_all_step if record_allocation else None, 
                                              ready=ready)
         
 
@@ -58,25 +65,53 @@ def synchronous_alloc_assign_repair_sequence(demand : np.ndarray,
                                              ends : np.ndarray,  
                                              workers_assigned : np.ndarray,  
                                              nWorker : float, 
-                                             workers_assigned_all_step : Dict[Any,Any], 
+                                             workers_assigned_all_step : Optional[AllocationTimeline], 
                                              ready : np.ndarray):
     
-    if np.max(demand) <= 0.0000001:
-        return
+    # Event loop, every pass assigns the available workers and then moves to the next event, 
+    # i.e., either a sequence finishes or a sequence becomes ready.
+    # The sets below are only updated for the sequences an event changes. Per event, the work is the size of the active
+    # set, since every sequence in progress has its time to finish and demand updated. A ready event also resets the
+    # capacity and returns the assigned workers, a sum over all the sequences kept so the totals are bit-identical
+
+    # Ready events, i.e., sequences that are not ready yet ordered by ready time (ties by index)
+    ready_events = [(ready[i], i) for i in np.where(ready > now)[0]]
+    heapq.heapify(ready_events)
+
+    # Sequences with demand left, demand only decreases so they are only ever removed
+    has_demand = demand > 0.0000001
+    n_with_demand = np.count_nonzero(has_demand)
+
+    # Ready sequences with demand left and some capacity, in ascending order: candidates are those available once the 
+    # capacity is reset, available those that can get workers now, i.e., with capacity left
+    candidates = np.where((ready <= now) & has_demand & (constraint > 0))[0]
+    available = np.where((ready <= now) & has_demand & (capacity > 0))[0]
+
+    # Total capacity left, kept as a running total
+    constraint_total = np.sum(constraint)
+    capacity_total = np.sum(capacity)
 
-    seq_ready = np.where(ready <= now)[0]
-    seq_not_ready = np.where(ready > now)[0]
+    # Active sequences, i.e., with a finite time to finish, in ascending order
+    active = np.empty(0, dtype=int)
+    is_active = np.zeros(len(demand), dtype=bool)
 
-    if len(seq_ready) > 0:
-        while nWorker > 0.01 and np.sum(capacity) > 0.01:
-            seq_with_demand = np.where(demand > 0.0000001)[0]
-            seq_with_capacity = np.where(capacity > 0)[0]
-            available = np.intersect1d(np.intersect1d(seq_ready, seq_with_demand), seq_with_capacity)
+    while n_with_demand > 0:
 
-            if len(available) == 0:
-                break
+        # Sequences that became ready, their capacity is untouched so far
+        became_ready = []
+        while ready_events and ready_events[0][0] <= now:
+            became_ready.append(heapq.heappop(ready_events)[1])
+
+        if became_ready:
+            became_ready = np.array(became_ready, dtype=int)
+            became_ready = became_ready[has_demand[became_ready] & (capacity[became_ready] > 0)]
+            candidates = np.union1d(candidates, became_ready)
+            available = np.union1d(available, became_ready)
+
+        while nWorker > 0.01 and capacity_total > 0.01 and len(available) > 0:
 
             seq_to_assign = available
+            nWorker_before = nWorker
             nWorker = synchronous_alloc_assign_workers(demand=demand,  
                                                        capacity=capacity,  
                                                        time2finish=time2finish,  
@@ -86,50 +121,73 @@ def synchronous_alloc_assign_repair_sequence(demand : np.ndarray,
                                                        sequences_index=seq_to_assign, 
                                                        workers_assigned=workers_assigned,
                                                        workers_assigned_all_step=workers_assigned_all_step)
-                                     
-
-    seq_index_to_finish = np.argmin(time2finish)
-    time_to_finish_next = time2finish[seq_index_to_finish]
-
-    time2nextReady = np.inf
-    if len(seq_not_ready) > 0:
-        seq_next_ready = seq_not_ready[np.argmin(ready[seq_not_ready])]
-        time2nextReady = ready[seq_next_ready] - now
-
-    if time_to_finish_next <= time2nextReady:
-
-        now += time_to_finish_next
-        time2finish -= time_to_finish_next
-
-        nWorker = synchronous_alloc_finish_sequence(demand=demand, 
-                                      time2finish=time2finish, 
-                                      now=now, 
-                                      ends=ends, 
-                                      time=time_to_finish_next, 
-                                      nWorker=nWorker, 
-                                      workers_assigned=workers_assigned, 
-                                      workers_assigned_all_step=workers_assigned_all_step)
-            
-    else:
-
-        now += time2nextReady
-        time2finish -= time2nextReady
-        demand -= time2nextReady * workers_assigned
-        capacity = constraint.copy()
-        nWorker += np.sum(workers_assigned)
-        workers_assigned[:] = 0
-
-    synchronous_alloc_assign_repair_sequence(demand=demand, 
-                                             constraint=constraint, 
-                                             capacity=capacity,  
-                                             time2finish=time2finish, 
-                                             now=now, 
-                                             starts=starts,  
-                                             ends=ends,  
-                                             workers_assigned=workers_assigned,  
-                                             nWorker=nWorker, 
-                                             workers_assigned_all_step=workers_assigned_all_step, 
-                                             ready=ready)
+            capacity_total -= nWorker_before - nWorker
+
+            # Sequences that get workers for the first time join the active set
+            new_active = seq_to_assign[~is_active[seq_to_assign]]
+            if len(new_active) > 0:
+                active = np.union1d(active, new_active)
+                is_active[new_active] = True
+
+            # Sequences with no capacity left are no longer available
+            available = seq_to_assign[capacity[seq_to_assign] > 0]
+                                         
+        # Only the active sequences can finish
+        time_to_finish_next = np.min(time2finish[active]) if len(active) > 0 else np.inf
+
+        time2nextReady = np.inf
+        if ready_events:
+            time2nextReady = ready_events[0][0] - now
+
+        # Nothing is being repaired and nothing will become ready, the remaining demand can never be met
+        if np.isinf(time_to_finish_next) and np.isinf(time2nextReady):
+            raise ValueError("Error, the remaining repair demand cannot be allocated, check that every floor and sequence with demand has worker capacity")
+
+        # Demand is only reduced for the active sequences, every other sequence has no workers assigned
+        in_progress = active
+
+        if time_to_finish_next <= time2nextReady:
+
+            now += time_to_finish_next
+            time2finish[active] -= time_to_finish_next
+
+            nWorker, active = synchronous_alloc_finish_sequence(demand=demand, 
+                                                                time2finish=time2finish, 
+                                                                now=now, 
+                                                                ends=ends, 
+                                                                time=time_to_finish_next, 
+                                                                nWorker=nWorker, 
+                                                                workers_assigned=workers_assigned, 
+                                                                workers_assigned_all_step=workers_assigned_all_step,
+                                                                active=active)
+            is_active[in_progress] = False
+            is_active[active] = True
+            reset_capacity = False
+                
+        else:
+
+            now += time2nextReady
+            time2finish[active] -= time2nextReady
+            demand[active] -= time2nextReady * workers_assigned[active]
+            capacity[:] = constraint
+            capacity_total = constraint_total
+            nWorker += np.sum(workers_assigned)
+            workers_assigned[active] = 0
+            reset_capacity = True
+
+        # Update the sequences with demand left
+        still_has_demand = demand[in_progress] > 0.0000001
+        n_done = np.count_nonzero(has_demand[in_progress] & ~still_has_demand)
+        n_with_demand -= n_done
+        has_demand[in_progress] = still_has_demand
+
+        if n_done > 0:
+            candidates = candidates[has_demand[candidates]]
+            available = available[has_demand[available]]
+
+        # Every candidate has its capacity back
+        if reset_capacity:
+            available = candidates
                                              
 
 def synchronous_alloc_assign_workers(demand : np.ndarray,  
@@ -140,28 +198,28 @@ def synchronous_alloc_assign_workers(demand : np.ndarray,
                                      nWorker : float, 
                                      sequences_index : np.ndarray, 
                                      workers_assigned : np.ndarray,
-                                     workers_assigned_all_step : Dict[Any,Any]) -> float :
+                                     workers_assigned_all_step : Optional[AllocationTimeline]) -> float :
     
-    total_demand = sum(demand[sequences_index])
+    # Running sums (np.cumsum) add up in order, i.e., the same as the built-in sum
+    total_demand = np.cumsum(demand[sequences_index])[-1]
 
     first_alloc = nWorker / total_demand * demand[sequences_index]
 
-    alloc = np.zeros(len(first_alloc))
-    for i in range(len(alloc)) :
-       alloc[i] = np.minimum(first_alloc[i], capacity[sequences_index[i]])
+    alloc = np.minimum(first_alloc, capacity[sequences_index])
 
     workers_assigned[sequences_index] += alloc
     capacity[sequences_index] -= alloc
     
     # udpate starts
     old_starts = starts[sequences_index]
-    starts[sequences_index] = [old_start if old_start >= 0 else now for old_start in old_starts]
+    starts[sequences_index] = np.where(old_starts >= 0, old_starts, now)
     
     time2finish[sequences_index] = demand[sequences_index] / workers_assigned[sequences_index]
 
-    workers_assigned_all_step[str(now)] = workers_assigned.copy()
+    if workers_assigned_all_step is not None:
+        workers_assigned_all_step.record(now, workers_assigned)
 
-    return nWorker - sum(alloc)  # update workers available
+    return nWorker - np.cumsum(alloc)[-1]  # update workers available
 
 
 def synchronous_alloc_finish_sequence(demand : np.ndarray, 
@@ -171,15 +229,16 @@ def synchronous_alloc_finish_sequence(demand : np.ndarray,
                                       time : float, 
                                       nWorker : float, 
                                       workers_assigned : np.ndarray, 
-                                      workers_assigned_all_step : Dict[Any,Any]) -> float :
+                                      workers_assigned_all_step : Optional[AllocationTimeline],
+                                      active : np.ndarray) -> Tuple[float, np.ndarray] :
     
-    seq_to_finish = np.where(np.abs(time2finish) < 0.000000001)[0]
+    finished = np.abs(time2finish[active]) < 0.000000001
+    seq_to_finish = active[finished]
     ends[seq_to_finish] = now
-    demand -= time * workers_assigned
+    demand[active] -= time * workers_assigned[active]
     time2finish[seq_to_finish] = np.inf  # set time2finish of this sequence to Inf, i.e. finished
     n_works_spared = np.sum(workers_assigned[seq_to_finish])
     workers_assigned[seq_to_finish] = 0
-    workers_assigned_all_step[now] = workers_assigned.copy()
-    return nWorker + n_works_spared
-
-
+    if workers_assigned_all_step is not None:
+        workers_assigned_all_step.record(now, workers_assigned)
+    return nWorker + n_works_spared, active[~finished]
@@ -1,4 +1,5 @@
 # conftest.py
+import pytest
 
 # Fixture files
 pytest_plugins = [
@@ -6,6 +7,16 @@ pytest_plugins = [
 ]
 
 
+@pytest.fixture(autouse=True)
+def redi_cache_dir(tmp_path, monkeypatch):
+    """
+    Compiled components libraries and indices are written to a temporary directory
+    """
+    cache_dir = tmp_path/'cache'
+    monkeypatch.setenv("REDI_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
 def pytest_configure(config):
     """
     Allows plugins and conftest files to perform initial configuration.
@@ -1,7 +1,14 @@
+import go_redi as go_redi_module
 from go_redi import (go_redi,
+                     go_redi_batch,
+                     prepare_building,
+                     load_components_library,
+                     clear_components_library_cache,
+                     run_realizations,
                      get_damage_by_component_all_DS, 
                      get_component_qty_all_floor, 
                      assign_repair_class,
+                     sample_repair_class,
                      get_damage_by_component_all_floors,
                      get_consequence_by_component_by_floor,
                      get_repair_sequence_by_floor,
@@ -14,10 +21,17 @@ from go_redi import (go_redi,
 
 
 from repair_schedules.get_repair_schedule import (get_worker_capacity,
+                                                  get_recommended_workers_mean,
                                                   get_constrained_workers,
                                                   get_repair_schedule_unit_realization)
 
-from utils.stat_utils import set_seed
+from impeding_delays import get_longlead_by_seq, get_contractor_mob_delay, get_impeding_delays_batch, IMPEDING_DELAY_TYPES, IMPEDING_DELAY_PATHS
+from parallel import go_redi_parallel
+from utils.stat_utils import set_seed, sample_dist_array, use_random_pool, get_realization_pool
+from building import Building, ComponentsLibrary, LazyComponentsLibrary
+
+import numpy as np
+import copy, sys, threading
 
 
 """
@@ -180,6 +194,228 @@ def test_individual_functions(test_building_1,
    assert(building_total_downtime[2]==166.57752442272385)
 
 
+def test_building_tensors(test_building_1) :
+
+   damage_tensor = test_building_1.damage_tensor
+   consequence_tensor = test_building_1.consequence_tensor
+
+   nComponents = len(test_building_1.damage_by_component)
+   nTotalFloor = test_building_1.nTotalFloor
+
+   assert(damage_tensor.values.shape[0]==nComponents)
+   assert(damage_tensor.values.shape[2]==nTotalFloor)
+   assert(consequence_tensor.values.shape[:3]==(nComponents, 4, nTotalFloor))
+
+   # Values are indexed by NISTR, the damage states missing for a component are zero
+   for NISTR, DS_by_floor in test_building_1.damage_by_component.items() :
+      i = damage_tensor.index[NISTR]
+      assert(damage_tensor.n_ds[i]==len(DS_by_floor))
+      assert(np.array_equal(damage_tensor.values[i, :len(DS_by_floor)], DS_by_floor))
+      assert(np.all(damage_tensor.values[i, len(DS_by_floor):]==0.0))
+
+   for NISTR, damage in test_building_1.total_consequences.items() :
+      i = consequence_tensor.index[NISTR]
+      assert(consequence_tensor.values[i, 1, 2, 0]==damage[1][2][0])
+
+   # The aggregations from the tensors are the same as from the dictionaries
+   comp_damage = test_building_1.damage_by_component
+   DS_by_component_all_DS = get_damage_by_component_all_DS(comp_damage, nTotalFloor, damage_tensor=damage_tensor)
+   for NISTR, DS_by_floor in comp_damage.items() :
+      assert(DS_by_component_all_DS[NISTR]==[np.sum([DS_by_floor[ds][floor] for ds in range(1, len(DS_by_floor))]) for floor in range(nTotalFloor)])
+
+
+def test_sample_repair_class(test_building_2,
+                             test_component_library_1) :
+
+   components_lib = load_components_library(test_component_library_1)
+
+   building = Building(building_dict=test_building_2)
+   prepare_building(building=building, components_lib=components_lib)
+
+   # Sampling several realizations at once consumes the random numbers in the same order as one realization at a time
+   set_seed(7)
+   expected = [list(assign_repair_class(building=building, components_lib=components_lib).values()) for _ in range(4)]
+
+   set_seed(7)
+   repair_class = sample_repair_class(building=building, components_lib=components_lib, n_realizations=4)
+
+   assert(repair_class.shape==(4, len(building.damage_by_component_all_floors)))
+   assert(np.array_equal(repair_class, expected))
+
+   # Components with no damage are never repaired
+   assert(np.all(repair_class[:, ~building.repair_class_inputs["damaged"]]==0))
+
+
+def test_recommended_workers_mean(test_building_2,
+                                  test_component_library_1) :
+
+   components_lib = load_components_library(test_component_library_1)
+
+   building = Building(building_dict=test_building_2)
+   prepare_building(building=building, components_lib=components_lib)
+
+   nTotalFloor = building.nTotalFloor
+   damage_qty = building.damage_by_component_all_DS
+
+   mean = get_recommended_workers_mean(building=building,
+                                       components_lib=components_lib,
+                                       floor_areas=building.floor_areas,
+                                       damage_qty=damage_qty,
+                                       nTotalFloor=nTotalFloor,
+                                       n_non_struc_sequence=7)
+
+   assert(mean.shape==(nTotalFloor, 7))
+
+   # The minimum of the floor area and the damaged components estimates, summed component by component
+   for floor in range(nTotalFloor) :
+      for seq in range(7) :
+         damaged_comp = 0.0
+         for NISTR, damage in damage_qty.items() :
+            if components_lib[NISTR]["seq"][0]==seq+1 :
+               damaged_comp += building.nworkers_recommended_mean[seq] * damage[floor]
+         assert(mean[floor, seq]==min(building.floor_areas[floor] / building.nwork_perfloor_divider[seq], damaged_comp))
+
+
+def test_longlead_by_seq(test_building_2,
+                        test_component_library_1) :
+
+   components_lib = load_components_library(test_component_library_1)
+
+   building = Building(building_dict=test_building_2)
+   prepare_building(building=building, components_lib=components_lib)
+
+   # Sampling several realizations at once consumes the random numbers in the same order as one realization at a time
+   set_seed(11)
+   expected = [get_longlead_by_seq(building=building, components_lib=components_lib, component_qty=building.component_qty) for _ in range(3)]
+
+   set_seed(11)
+   longlead_by_seq = get_longlead_by_seq(building=building, components_lib=components_lib, component_qty=building.component_qty, n_realizations=3)
+
+   assert(longlead_by_seq.shape==(3, building.n_sequences))
+   assert(np.array_equal(longlead_by_seq, expected))
+   assert(np.any(longlead_by_seq > 0.0))
+
+   # Only the sequences of the components with a long lead time can be delayed
+   assert(np.all(longlead_by_seq[:, np.setdiff1d(np.arange(building.n_sequences), building.longlead_inputs["seq"])]==0.0))
+
+
+def test_contractor_mob_delay(test_building_2) :
+
+   building = Building(building_dict=test_building_2)
+
+   max_nonstruct_rc = np.array([[0, 1, 2, 3, 0, 1, 0, 3],
+                                [3, 0, 0, 1, 2, 0, 0, 0]])
+
+   # Stacked realizations consume the random numbers in the same order as one realization at a time
+   set_seed(13)
+   expected = [get_contractor_mob_delay(building=building, max_nonstruct_rc=rc.tolist()) for rc in max_nonstruct_rc]
+
+   set_seed(13)
+   delays = get_contractor_mob_delay(building=building, max_nonstruct_rc=max_nonstruct_rc)
+
+   assert(np.array_equal(delays, expected))
+
+   # No delay for the sequences without nonstructural damage
+   assert(np.all((delays > 0.0)==(max_nonstruct_rc > 0)))
+
+   # By default the rc23 parameters are used for every sequence, with rc1_by_seq the rc1 ones for a repair class of 1
+   sampled = max_nonstruct_rc > 0
+   for rc1_by_seq in [False, True] :
+      building.con_delay_rc1_by_seq = rc1_by_seq
+      rc = np.where((max_nonstruct_rc==1) & rc1_by_seq, 0, 1)[sampled]
+
+      set_seed(13)
+      delays = get_contractor_mob_delay(building=building, max_nonstruct_rc=max_nonstruct_rc)
+
+      set_seed(13)
+      expected = sample_dist_array(building.con_delay_params["distribution"], 
+                                   building.con_delay_theta_by_seq[rc, np.nonzero(sampled)[1]], 
+                                   building.con_delay_sigma_by_seq[rc, np.nonzero(sampled)[1]])
+
+      assert(np.array_equal(delays[sampled], expected))
+
+   # The flag is read from the building input, off if missing
+   assert(Building(building_dict=test_building_2).con_delay_rc1_by_seq==False)
+
+   building_dict = copy.deepcopy(test_building_2)
+   del building_dict["risk_parameters"]["impeding_factors"]["contractor_mobilization_delay_seismic"]["rc1_by_seq"]
+   assert(Building(building_dict=building_dict).con_delay_rc1_by_seq==False)
+
+   set_seed(13)
+   delays_rc23 = get_contractor_mob_delay(building=Building(building_dict=building_dict), max_nonstruct_rc=max_nonstruct_rc)
+
+   building_dict["risk_parameters"]["impeding_factors"]["contractor_mobilization_delay_seismic"]["rc1_by_seq"] = True
+   building_rc1 = Building(building_dict=building_dict)
+   assert(building_rc1.con_delay_rc1_by_seq==True)
+
+   set_seed(13)
+   delays_rc1 = get_contractor_mob_delay(building=building_rc1, max_nonstruct_rc=max_nonstruct_rc)
+
+   # Only the sequences with a maximum repair class of 1 change
+   assert(np.array_equal(delays_rc1[max_nonstruct_rc!=1], delays_rc23[max_nonstruct_rc!=1]))
+   assert(np.all(delays_rc1[max_nonstruct_rc==1]!=delays_rc23[max_nonstruct_rc==1]))
+
+
+def test_impeding_delays_batch(test_building_2,
+                               test_component_library_1) :
+
+   components_lib = load_components_library(test_component_library_1)
+
+   building = Building(building_dict=test_building_2)
+   prepare_building(building=building, components_lib=components_lib)
+
+   set_seed(3)
+   repair_class = assign_repair_class(building=building, components_lib=components_lib)
+   repair_sequence_by_floor = get_repair_sequence_by_floor(repair_class_by_component=repair_class,
+                                                           consequence_by_component_by_floor=building.consequence_by_component_by_floor,
+                                                           nTotalFloor=building.nTotalFloor,
+                                                           components_lib=components_lib,
+                                                           n_sequences=building.n_sequences,
+                                                           n_repair_goal=building.n_repair_goal)
+   repair_sequence = get_repair_sequence(repair_sequence_by_floor=repair_sequence_by_floor,
+                                         nTotalFloor=building.nTotalFloor,
+                                         n_sequences=building.n_sequences,
+                                         n_repair_goal=building.n_repair_goal)
+
+   # A single realization is the same as get_impeding_delays
+   set_seed(5)
+   max_delay, impeding_delays = get_impeding_delays(building=building, components_lib=components_lib, 
+                                                    repair_sequence=repair_sequence, component_qty=building.component_qty)
+
+   set_seed(5)
+   max_delay_batch, max_delay_path, delays = get_impeding_delays_batch(building=building, components_lib=components_lib, 
+                                                                       repair_sequence=np.array([repair_sequence]), component_qty=building.component_qty)
+
+   assert(max_delay_batch[0]==max_delay)
+   assert(np.array_equal(delays[0, :len(IMPEDING_DELAY_TYPES)], [impeding_delays[key] for key in IMPEDING_DELAY_TYPES]))
+   assert(delays[0, len(IMPEDING_DELAY_TYPES)]==impeding_delays["struct_contractor_mobilization_delays"])
+   assert(np.array_equal(delays[0, len(IMPEDING_DELAY_TYPES)+1:], impeding_delays["nonstruct_contractor_mobilization_delays"]))
+
+   # Realizations without damage have no permit delay
+   repair_sequences = np.stack([repair_sequence, np.zeros_like(repair_sequence), repair_sequence])
+   max_delay_batch, max_delay_path, delays = get_impeding_delays_batch(building=building, components_lib=components_lib, 
+                                                                       repair_sequence=repair_sequences, component_qty=building.component_qty)
+
+   assert(delays.shape==(3, len(IMPEDING_DELAY_TYPES) + building.n_sequences))
+   assert(delays[1, 3]==0.0 and delays[1, 0] > 0.0)
+   assert(np.all(max_delay_batch >= delays[:, 0]))
+
+   # Entries of the delay parameters that are not delay types are ignored
+   set_seed(5)
+   building.finance_delay_params = {**building.finance_delay_params, "source" : {"reference" : "FEMA P-58"}}
+   max_delay_extra, _, delays_extra = get_impeding_delays_batch(building=building, components_lib=components_lib, 
+                                                                repair_sequence=np.array([repair_sequence]), component_qty=building.component_qty)
+   assert(max_delay_extra[0]==max_delay)
+   assert(delays_extra[0, IMPEDING_DELAY_TYPES.index("financing_delay")]==impeding_delays["financing_delay"])
+
+   # The max delay path gives the max delay
+   insp, eng, finance, permit = delays[:, :len(IMPEDING_DELAY_TYPES)].T
+   delay_paths = np.stack([insp + finance, insp + eng + permit, insp + delays[:, len(IMPEDING_DELAY_TYPES)]], axis=1)
+   assert(max_delay_path.shape==(3,) and np.all(max_delay_path < len(IMPEDING_DELAY_PATHS)))
+   assert(np.array_equal(max_delay_batch, delay_paths.max(axis=1)))
+   assert(np.array_equal(delay_paths[np.arange(3), max_delay_path], max_delay_batch))
+
+
 def test_go_redi(test_building_2,
                  test_component_library_1) :
    
@@ -191,3 +427,256 @@ def test_go_redi(test_building_2,
    assert(res['building_total_downtime'][0]==398.83159383072984)
    assert(res['building_total_downtime'][1]==380.36699459844033)
    assert(res['building_total_downtime'][2]==166.57752442272385)
+
+
+def test_go_redi_incomplete_unused_component(test_building_2,
+                                             test_component_library_1) :
+
+   expected = go_redi(building_dict=test_building_2, components_lib_dict=test_component_library_1, seed=123)
+
+   # Entries of the library the building does not use are never read, even if they lack fields or are malformed
+   library = copy.deepcopy(test_component_library_1.library)
+   library["Z9999.999"] = {"seq" : [1, [2, 3]], "long_lead" : "n/a"}
+
+   res = go_redi(building_dict=test_building_2, components_lib_dict=library, seed=123)
+
+   assert(np.array_equal(res['building_total_downtime'], expected['building_total_downtime']))
+
+
+def test_go_redi_threads_shared_library(test_building_2,
+                                       test_component_library_1) :
+
+   # Buildings with different components, run concurrently against one library, each one registers new components
+   # while the others read the arrays
+   components_lib = load_components_library(copy.deepcopy(test_component_library_1.library))
+
+   # Each building swaps its components for other components of the library with the same damage states
+   library = test_component_library_1.library
+   by_n_ds = {}
+   for NISTR, component in library.items() :
+      by_n_ds.setdefault((component["n_ds"], len(component["rds"])), []).append(NISTR)
+
+   building_dicts = []
+   for i in range(12) :
+      building_dict = copy.deepcopy(test_building_2)
+      candidates = {NISTR: by_n_ds[(library[NISTR]["n_ds"], len(library[NISTR]["rds"]))] for NISTR in building_dict["component_damage"]}
+      renamed = {NISTR: candidates[NISTR][(candidates[NISTR].index(NISTR) + i) % len(candidates[NISTR])] for NISTR in candidates}
+      if len(set(renamed.values())) < len(renamed) :
+         renamed = {NISTR: NISTR for NISTR in renamed}
+
+      building_dict["component_damage"] = {renamed[NISTR]: damage for NISTR, damage in building_dict["component_damage"].items()}
+      building_dict["total_consequences"] = {renamed.get(NISTR, NISTR): consequences for NISTR, consequences in building_dict["total_consequences"].items()}
+      for floor in building_dict["components"] :
+         for component in floor :
+            component["NISTR"] = renamed.get(component["NISTR"], component["NISTR"])
+      building_dicts.append(building_dict)
+
+   NISTRs = sorted({NISTR for building_dict in building_dicts for NISTR in building_dict["component_damage"]})
+
+   # Each thread draws from its own random pool, the results are the same as run one at a time with another library
+   def run_building(i, components_lib) :
+      with use_random_pool(get_realization_pool(123, i)) :
+         return go_redi(building_dict=building_dicts[i], components_lib_dict=components_lib)
+
+   serial_lib = ComponentsLibrary(components_lib_dict=copy.deepcopy(library))
+   expected = [run_building(i, serial_lib) for i in range(len(building_dicts))]
+
+   barrier = threading.Barrier(len(building_dicts))
+   errors = []
+   results = {}
+
+   # Every thread runs every building, starting from a different one
+   def run(thread) :
+      try :
+         barrier.wait()
+         for j in range(len(building_dicts)) :
+            i = (thread + j) % len(building_dicts)
+            results[(thread, i)] = run_building(i, components_lib)
+      except Exception as e :
+         errors.append(e)
+
+   # Switch threads often, so that they interleave within the library calls
+   switch_interval = sys.getswitchinterval()
+   sys.setswitchinterval(1e-6)
+   try :
+      threads = [threading.Thread(target=run, args=(i,)) for i in range(len(building_dicts))]
+      for thread in threads :
+         thread.start()
+      for thread in threads :
+         thread.join()
+   finally :
+      sys.setswitchinterval(switch_interval)
+
+   assert(errors==[])
+   assert(len(results)==len(building_dicts)**2)
+   for (_, i), res in results.items() :
+      assert(np.array_equal(res['building_total_downtime'], expected[i]['building_total_downtime']))
+
+   # Every component used has an ID, and a row in the arrays
+   ids = components_lib.component_ids(NISTRs)
+   assert(sorted(ids.tolist())==list(range(len(NISTRs))))
+   assert(len(components_lib.seq)==len(NISTRs))
+
+
+def test_components_library_cache(test_building_2,
+                                   test_component_library_1,
+                                   monkeypatch) :
+
+   clear_components_library_cache()
+   monkeypatch.setattr(go_redi_module, "COMPONENTS_LIB_CACHE_SIZE", 2)
+
+   library = copy.deepcopy(test_component_library_1.library)
+
+   # The same dictionary, or an equal one, gives the same library
+   components_lib = load_components_library(library)
+   assert(load_components_library(library) is components_lib)
+   assert(load_components_library(copy.deepcopy(library)) is components_lib)
+
+   # A different library is not replaced by the one loaded first
+   library_rc0 = copy.deepcopy(library)
+   for component in library_rc0.values() :
+      component["rds"] = [0 for _ in component["rds"]]
+
+   res = go_redi(building_dict=test_building_2, components_lib_dict=library, seed=123, burn_in=248)
+   res_rc0 = go_redi(building_dict=test_building_2, components_lib_dict=library_rc0, seed=123, burn_in=248)
+
+   assert(max(res['repair_class'].values()) > 0)
+   assert(max(res_rc0['repair_class'].values())==0)
+   assert(load_components_library(library_rc0) is not components_lib)
+
+   # The least recently used library is evicted
+   load_components_library(None)
+   assert(load_components_library(library) is not components_lib)
+
+   # Only the components used are hashed, libraries that differ in other components share the same library
+   NISTRs = test_building_2["component_damage"].keys()
+   library_extra = copy.deepcopy(library)
+   library_extra["Z9999.999"] = ["not", "a", "component"]
+
+   components_lib = load_components_library(copy.deepcopy(library), NISTRs=NISTRs)
+   assert(load_components_library(library_extra, NISTRs=NISTRs) is components_lib)
+   assert(load_components_library(library_rc0, NISTRs=NISTRs) is not components_lib)
+
+
+def test_go_redi_lazy_components(test_building_2,
+                                 test_component_library_1) :
+
+   lazy = LazyComponentsLibrary(json_path='./data/components_library.json')
+
+   res = go_redi_batch(building_dict=test_building_2,
+                       n_realizations=2,
+                       components_lib_dict=lazy,
+                       seed=123)
+
+   res_eager = go_redi_batch(building_dict=test_building_2,
+                             n_realizations=2,
+                             components_lib_dict=test_component_library_1,
+                             seed=123)
+
+   # Only the components of the building are parsed, the results are the same
+   assert(len(lazy.library)==len(test_building_2['component_damage']))
+   assert(np.array_equal(res['building_total_downtime'], res_eager['building_total_downtime']))
+
+
+def test_go_redi_batch(test_building_2,
+                       test_component_library_1) :
+   
+   res = go_redi_batch(building_dict=test_building_2,
+                       n_realizations=3,
+                       components_lib_dict=test_component_library_1,
+                       seed=123,
+                       burn_in=248)
+
+   assert(res['building_total_downtime'].shape==(3,3))
+   assert(res['repair_class'].shape==(3,len(res['components'])))
+   assert(res['impeding_delays']['nonstruct_contractor_mobilization_delays'].shape==(3,7))
+   assert(res['seed']==123)
+
+   # Every realization has its own stream, running them one by one and in reverse gives the same results
+   building = Building(building_dict=test_building_2)
+   prepare_building(building=building, components_lib=test_component_library_1)
+
+   # The realization-invariant inputs are computed once and frozen
+   component_qty = building.component_qty
+   assert(building.prepared)
+   assert(not building.recommended_workers_mean.flags.writeable)
+
+   for realization in reversed(range(3)) :
+      single = run_realizations(building=building,
+                                components_lib=test_component_library_1,
+                                realizations=[realization],
+                                entropy=123,
+                                burn_in=248)
+
+      assert(np.array_equal(res['building_total_downtime'][realization], single['building_total_downtime'][0]))
+      assert(np.array_equal(res['repair_class'][realization], single['repair_class'][0]))
+      assert(res['max_delay'][realization]==single['max_delay'][0])
+
+   assert(building.component_qty is component_qty)
+
+   # A larger batch starts with the same realizations
+   res_5 = go_redi_batch(building_dict=test_building_2,
+                         n_realizations=5,
+                         components_lib_dict=test_component_library_1,
+                         seed=123,
+                         burn_in=248)
+
+   assert(np.array_equal(res['building_total_downtime'], res_5['building_total_downtime'][:3]))
+
+
+def test_go_redi_parallel(test_building_2,
+                          test_component_library_1) :
+
+   building_dicts = [test_building_2, test_building_2]
+
+   res = go_redi_parallel(building_dicts=building_dicts,
+                          n_realizations=5,
+                          components_lib_dict=test_component_library_1,
+                          seed=123,
+                          n_workers=2,
+                          chunk_size=2)
+
+   assert(len(res)==2)
+
+   # Each building is identical to a serial batch run with the seed of the building, whatever the chunking
+   for building_index, building_dict in enumerate(building_dicts) :
+      serial = go_redi_batch(building_dict=building_dict,
+                             n_realizations=5,
+                             components_lib_dict=test_component_library_1,
+                             seed=[123, building_index])
+
+      assert(np.array_equal(res[building_index]['realizations'], np.arange(5)))
+      assert(np.array_equal(res[building_index]['building_total_downtime'], serial['building_total_downtime']))
+      assert(np.array_equal(res[building_index]['repair_class'], serial['repair_class']))
+      assert(np.array_equal(res[building_index]['impeding_delays']['inspection_delay'], serial['impeding_delays']['inspection_delay']))
+
+   # Buildings get independent streams
+   assert(not np.array_equal(res[0]['building_total_downtime'], res[1]['building_total_downtime']))
+
+
+def test_go_redi_parallel_prepare_once(test_building_2,
+                                       test_component_library_1,
+                                       monkeypatch) :
+
+   import parallel
+
+   prepared = []
+   def counting_prepare_building(building, components_lib) :
+      prepared.append(building)
+      prepare_building(building=building, components_lib=components_lib)
+
+   monkeypatch.setattr(parallel, "prepare_building", counting_prepare_building)
+
+   # Three chunks per building, each building is prepared once by the worker
+   res = go_redi_parallel(building_dicts=[test_building_2, test_building_2],
+                          n_realizations=5,
+                          components_lib_dict=test_component_library_1,
+                          seed=123,
+                          n_workers=1,
+                          chunk_size=2)
+
+   assert(len(prepared)==2)
+
+   serial = go_redi_batch(building_dict=test_building_2, n_realizations=5, components_lib_dict=test_component_library_1, seed=[123, 1])
+   assert(np.array_equal(res[1]['building_total_downtime'], serial['building_total_downtime']))
+
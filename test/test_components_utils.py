@@ -0,0 +1,115 @@
+import json, copy
+import numpy as np
+
+from utils.components_utils import (ENGINE_FIELDS, load_components_library_file, read_compiled_components_library, 
+                                    get_compiled_library_path, get_components_index_path, get_file_hash)
+from building import LazyComponentsLibrary
+
+
+def test_compiled_components_library(tmp_path,
+                                     redi_cache_dir,
+                                     test_component_library_1) :
+
+   library = copy.deepcopy(test_component_library_1.library)
+
+   json_path = tmp_path/'components_library.json'
+   with open(json_path, 'w') as f :
+      json.dump(library, f)
+
+   expected = {NISTR: {key: component[key] for key in ENGINE_FIELDS if key in component} for NISTR, component in library.items()}
+
+   # The first load compiles the library, the second one reads it
+   assert(load_components_library_file(json_path)==expected)
+
+   # The compiled library is written to the cache directory, not next to the JSON file
+   compiled_path = get_compiled_library_path(json_path)
+   assert(compiled_path.exists() and compiled_path.parent==redi_cache_dir)
+   assert(sorted(path.name for path in tmp_path.glob('*.npz'))==[])
+
+   compiled = read_compiled_components_library(compiled_path, source_hash=get_file_hash(json_path))
+   assert(compiled==expected)
+   assert(list(compiled.keys())==list(expected.keys()))
+
+   # A change in the JSON file invalidates the compiled library
+   NISTR = next(iter(library))
+   library[NISTR]["rds"] = [rc + 1 for rc in library[NISTR]["rds"]]
+   with open(json_path, 'w') as f :
+      json.dump(library, f)
+
+   assert(read_compiled_components_library(compiled_path, source_hash=get_file_hash(json_path)) is None)
+   assert(load_components_library_file(json_path)[NISTR]["rds"]==library[NISTR]["rds"])
+   assert(read_compiled_components_library(compiled_path, source_hash=get_file_hash(json_path)) is not None)
+
+   # Or to the path given
+   out_path = tmp_path/'compiled'/'library.npz'
+   assert(load_components_library_file(json_path, compiled_path=out_path)==load_components_library_file(json_path))
+   assert(out_path.exists())
+
+
+def test_lazy_components_library(tmp_path,
+                                 test_component_library_1) :
+
+   library = copy.deepcopy(test_component_library_1.library)
+
+   # Non-ASCII characters make the byte offsets differ from the character offsets
+   NISTR = next(iter(library))
+   library[NISTR]["Description"] = "Résumé – ünïcode"
+
+   json_path = tmp_path/'components_library.json'
+   with open(json_path, 'w', encoding='utf-8') as f :
+      json.dump(library, f, indent=2, ensure_ascii=False)
+
+   lazy = LazyComponentsLibrary(json_path)
+
+   # Nothing is parsed until it is accessed
+   assert(len(lazy)==len(library))
+   assert(len(lazy.library)==0)
+
+   NISTRs = list(library.keys())
+   assert(lazy[NISTRs[0]]==library[NISTRs[0]])
+   assert(lazy[NISTRs[-1]]==library[NISTRs[-1]])
+   assert(len(lazy.library)==2)
+
+   lazy.load(NISTRs[:10])
+   assert(len(lazy.library)==11)
+   assert(all(lazy[NISTR]==library[NISTR] for NISTR in NISTRs))
+
+   # The index is rebuilt when the JSON file changes
+   library[NISTRs[1]]["seq"] = [5, 5]
+   with open(json_path, 'w') as f :
+      json.dump(library, f)
+
+   assert(LazyComponentsLibrary(json_path)[NISTRs[1]]["seq"]==[5, 5])
+   assert(get_components_index_path(json_path).exists())
+   assert(sorted(path.name for path in tmp_path.glob('*.npz'))==[])
+
+
+def test_components_library_arrays(test_component_library_1) :
+
+   library = test_component_library_1.library
+   NISTRs = ['D3041.031b', 'B1031.001', 'C3027.002']
+
+   ids = test_component_library_1.component_ids(NISTRs)
+
+   for i, NISTR in zip(ids, NISTRs) :
+      component = library[NISTR]
+      assert(list(test_component_library_1.seq[i])==component["seq"])
+      assert(test_component_library_1.n_ds[i]==component["n_ds"])
+      assert(list(test_component_library_1.rds[i, :test_component_library_1.rds_len[i]])==component["rds"])
+      assert(np.all(test_component_library_1.rds[i, test_component_library_1.rds_len[i]:]==0))
+      assert(list(test_component_library_1.long_lead[i, :test_component_library_1.long_lead_len[i]])==component["long_lead"])
+
+
+def test_lazy_components_library_arrays() :
+
+   lazy = LazyComponentsLibrary(json_path='./data/components_library.json')
+
+   first_ids = lazy.component_ids(['B1031.001', 'C3027.002'])
+   assert(list(first_ids)==[0, 1])
+   assert(len(lazy.seq)==2)
+
+   # Loading more components rebuilds the arrays, the IDs already given do not change
+   ids = lazy.component_ids(['D3041.031b', 'C3027.002'])
+   assert(list(ids)==[2, 1])
+   assert(len(lazy.seq)==3)
+   assert(list(lazy.seq[ids[0]])==lazy['D3041.031b']["seq"])
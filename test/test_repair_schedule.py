@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+
+from repair_schedules.scheduling_optimization.synchronous_alloc import synchronous_alloc
+from repair_schedules.scheduling_optimization.get_optimized_repair_schedule import get_optimized_repair_schedule_diff_start
+from repair_schedules.scheduling_optimization.allocation_timeline import AllocationTimeline
+from repair_schedules.get_repair_schedule import adjust_capacity
+
+
+"""
+   Stress test of the scheduler for a tall building, i.e., with more events than the default recursion limit
+   
+"""
+def test_synchronous_alloc_tall_building() :
+
+   rng = np.random.default_rng(1)
+
+   nFloor = 150
+   n_non_struc_sequence = 7
+
+   demand = 100.0 * rng.random((nFloor, n_non_struc_sequence))
+   capacity = 1.0 + 5.0 * rng.random((nFloor, n_non_struc_sequence))
+   ready = 50.0 * rng.random((nFloor, n_non_struc_sequence))
+
+   r = get_optimized_repair_schedule_diff_start(demand=demand,
+                                                capacity=capacity,
+                                                nFloor=nFloor,
+                                                nWorker=30.0,
+                                                ready=ready,
+                                                struc_repair_days=0.0,
+                                                n_non_struc_sequence=n_non_struc_sequence)
+
+   assert(r["starts"].shape==(nFloor, n_non_struc_sequence))
+
+   # Every floor and sequence is repaired, none starts before it is ready
+   assert(np.all(r["starts"] >= ready))
+   assert(np.all(r["ends"] > r["starts"]))
+   assert(r["total_span"]==np.max(r["ends"]))
+
+   # The allocation timeline is reshaped by floor, every repair is finished at the end
+   times, dense = r["allocation"].to_dense()
+   assert(dense.shape==(len(times), nFloor, n_non_struc_sequence))
+   assert(np.all(np.diff(times) > 0))
+   assert(np.array_equal(r["allocation"].state_at(times[-1]), np.zeros((nFloor, n_non_struc_sequence))))
+
+
+def test_synchronous_alloc_no_capacity() :
+
+   # Demand without any worker capacity can never be repaired
+   with pytest.raises(ValueError):
+      synchronous_alloc(demand=np.array([10.0, 5.0]),
+                        constraint=np.array([2.0, 0.0]),
+                        nWorker=10.0,
+                        ready=np.array([0.0, 0.0]))
+
+
+def test_synchronous_alloc_record_allocation() :
+
+   rng = np.random.default_rng(2)
+
+   demand = 100.0 * rng.random(35)
+   constraint = 1.0 + 5.0 * rng.random(35)
+   ready = 50.0 * rng.random(35)
+
+   r = synchronous_alloc(demand=demand, constraint=constraint, nWorker=30.0, ready=ready)
+   r_no_alloc = synchronous_alloc(demand=demand, constraint=constraint, nWorker=30.0, ready=ready, record_allocation=False)
+
+   # The schedule is the same, only the allocation history is skipped
+   assert(len(r["allocation"]) > 0)
+   assert(len(r_no_alloc["allocation"])==0)
+   assert(np.array_equal(r["starts"], r_no_alloc["starts"]))
+   assert(np.array_equal(r["ends"], r_no_alloc["ends"]))
+   assert(r["total_span"]==r_no_alloc["total_span"])
+
+
+def test_allocation_timeline() :
+
+   rng = np.random.default_rng(3)
+
+   timeline = AllocationTimeline(40, shape=(8, 5), order='F')
+
+   times = [0.0, 1.5, 1.5, 2.0, 4.25]
+   states = []
+   state = np.zeros(40)
+   for time in times :
+      # Change a few cells, or most of them
+      cells = rng.choice(40, size=int(rng.integers(1, 40)), replace=False)
+      state = state.copy()
+      state[cells] = rng.random(len(cells))
+      states.append(state)
+      timeline.record(time, state)
+
+   # Events at the same time are merged, the last state is kept
+   event_times, dense = timeline.to_dense()
+   assert(np.array_equal(event_times, [0.0, 1.5, 2.0, 4.25]))
+   for i, k in enumerate([0, 2, 3, 4]) :
+      assert(np.array_equal(dense[i], np.reshape(states[k], (8, 5), order='F')))
+
+   assert(np.array_equal(timeline.state_at(-1.0), np.zeros((8, 5))))
+   assert(np.array_equal(timeline.state_at(3.0), dense[2]))
+
+   # Unchanged states are not recorded
+   timeline.record(5.0, states[-1])
+   assert(len(timeline)==4)
+
+   with pytest.raises(ValueError):
+      timeline.record(1.0, np.ones(40))
+
+
+def test_adjust_capacity() :
+
+   capacity = np.array([[4.0, 1.0, 0.0],
+                        [0.0, 2.0, 0.0],
+                        [6.0, 3.0, 5.0]])
+   constraint = np.array([5.0, 10.0, 2.0])
+
+   adjusted = adjust_capacity(capacity=capacity, nTotalFloor=3, constraint=constraint, n_non_struc_sequence=3)
+
+   # The constraint is split among the floors with demand, only for the sequences exceeding it
+   assert(np.array_equal(adjusted, [[2.5, 1.0, 0.0],
+                                    [0.0, 2.0, 0.0],
+                                    [2.5, 3.0, 2.0]]))
+   assert(capacity[0, 0]==4.0)
+
+   # Stacked realizations are adjusted independently
+   rng = np.random.default_rng(0)
+   capacity = 10.0 * rng.random((4, 20, 7)) * (rng.random((4, 20, 7)) < 0.5)
+   constraint = 30.0 * rng.random((4, 7))
+
+   adjusted = adjust_capacity(capacity=capacity, nTotalFloor=20, constraint=constraint, n_non_struc_sequence=7)
+
+   assert(adjusted.shape==(4, 20, 7))
+   for r in range(4) :
+      assert(np.array_equal(adjusted[r], adjust_capacity(capacity=capacity[r], nTotalFloor=20, constraint=constraint[r], n_non_struc_sequence=7)))
@@ -0,0 +1,171 @@
+import threading
+import numpy as np
+import pytest
+
+from scipy.stats import lognorm, truncnorm
+
+from utils.stat_utils import RandomPool, get_realization_pool, use_random_pool, gen_random, set_seed, sample_dist, sample_dist_array, lognormal_ppf, lognormal_cdf, truncnorm_ppf
+from utils.stat_utils import get_percentile, enable_sampling_counters, reset_sampling_counters, get_sampling_counts
+
+
+"""
+   This tests that sample_dist_array gives the same samples as repeated calls to sample_dist
+   
+"""
+@pytest.mark.parametrize("distribution,var1,var2", [("Lognormal", [0.0, 1.5, 20.0, 0.0, 300.0, 7.0], 0.4),
+                                                    ("Normal", [28.0, 150.5, 0.0, 5.0, 50.4, 90.0], [9.083, 50.4, 1.0, 20.0, 52.5, 1.0]),
+                                                    ("Uniform", [0.0, 1.0, 2.0, -5.0, 10.0, 3.0], 12.0)])
+def test_sample_dist_array(distribution, var1, var2) :
+
+   set_seed(123,248)
+   expected = [sample_dist(distribution, v1, v2) for v1, v2 in np.broadcast(var1, var2)]
+
+   set_seed(123,248)
+   samples = sample_dist_array(distribution, var1, var2)
+
+   assert(samples.shape==(6,))
+   assert(np.array_equal(samples, expected))
+
+   # Multi-dimensional output is drawn in C-order
+   set_seed(123,248)
+   samples = sample_dist_array(distribution, np.reshape(var1, (2,3)), np.broadcast_to(var2, (6,)).reshape((2,3)))
+
+   assert(np.array_equal(samples.ravel(), expected))
+
+
+def test_sample_dist_array_size() :
+
+   set_seed(123,248)
+   expected = [sample_dist("Lognormal", 5.0, 0.2) for _ in range(12)]
+
+   set_seed(123,248)
+   samples = sample_dist_array("Lognormal", 5.0, 0.2, size=(4,3))
+
+   assert(samples.shape==(4,3))
+   assert(np.array_equal(samples.ravel(), expected))
+
+   with pytest.raises(ValueError):
+      sample_dist_array("Weibull", 5.0, 0.2, size=3)
+
+
+def test_lognormal_ppf() :
+
+   # The closed-form inverse CDF has to be bit-identical to scipy so that seeded results do not change
+   rng = np.random.default_rng(0)
+   rnd_num = np.concatenate([rng.random(10000), [0.0, 1e-300, 0.5, 1.0-1e-16]])
+   mean = np.exp(rng.normal(0.0, 5.0, rnd_num.size))
+   beta = 0.01 + 2.0*rng.random(rnd_num.size)
+
+   expected = lognorm.ppf(rnd_num, s=beta, scale=np.exp(np.log(mean)))
+
+   assert(np.array_equal(lognormal_ppf(rnd_num, mean, beta), expected))
+   assert(lognormal_ppf(rnd_num[0], mean[0], beta[0])==expected[0])
+
+
+def test_lognormal_cdf() :
+
+   # Bit-identical to scipy, including outside of the support
+   rng = np.random.default_rng(0)
+   x = np.concatenate([rng.random(5000), 50.0*rng.random(5000), [0.0, -1.0, 1e-300, np.inf]])
+   mean = 0.001 + 2.0*rng.random(x.size)
+   beta = 0.01 + 2.0*rng.random(x.size)
+
+   expected = lognorm.cdf(x, s=beta, scale=np.exp(np.log(mean)))
+
+   assert(np.array_equal(lognormal_cdf(x, mean, beta), expected))
+   assert(lognormal_cdf(x[0], mean[0], beta[0])==expected[0])
+
+
+def test_truncnorm_ppf() :
+
+   # Bit-identical to scipy for positive, zero and negative means, both per scalar and in batch
+   rng = np.random.default_rng(0)
+   rnd_num = np.concatenate([rng.random(10000), [0.0, 1e-300, 0.5, 0.999999]])
+   mean = np.concatenate([rng.normal(50.0, 80.0, 10000), [28.0, 0.0, -3.0, 1e-3]])
+   stdev = np.concatenate([0.01 + 100.0*rng.random(10000), [9.083, 2.0, 1.0, 5.0]])
+
+   expected = truncnorm.ppf(rnd_num, a=(0-mean)/stdev, b=np.inf, loc=mean, scale=stdev)
+
+   assert(np.array_equal(truncnorm_ppf(rnd_num, mean, stdev), expected, equal_nan=True))
+
+   for i in range(0, len(rnd_num), 101) :
+      assert(truncnorm_ppf(rnd_num[i], mean[i], stdev[i])==expected[i])
+
+   # Far in the upper tail of a negative mean
+   assert(np.isfinite(truncnorm_ppf(0.999, -200.0, 1.0)))
+   assert(np.isnan(truncnorm_ppf(0.5, 10.0, 0.0)))
+
+
+def test_random_pool() :
+
+   # The pool has to hand out exactly the numbers the generator gives when drawing one at a time
+   expected = np.random.default_rng(7).random(100)
+
+   pool = RandomPool(np.random.default_rng(7), block_size=8)
+
+   rnd_nums = [pool.random() for _ in range(5)]
+   rnd_nums.extend(pool.random_array(2))
+   rnd_nums.extend(pool.random_array(20))
+   pool.discard(3)
+   rnd_nums.extend([pool.random() for _ in range(10)])
+   pool.discard(30)
+   rnd_nums.extend(pool.random_array(30))
+
+   assert(np.array_equal(rnd_nums, np.concatenate([expected[:27], expected[30:40], expected[70:]])))
+
+
+def test_realization_pools() :
+
+   # Realization k is the k-th child of the seed sequence
+   expected = [np.random.default_rng(child).random(50) for child in np.random.SeedSequence(123).spawn(4)]
+
+   # Draw the realizations on separate threads, in reverse order
+   results = {}
+
+   def draw(realization) :
+      with use_random_pool(get_realization_pool(123, realization)) :
+         results[realization] = [gen_random() for _ in range(50)]
+
+   threads = [threading.Thread(target=draw, args=(realization,)) for realization in reversed(range(4))]
+   for thread in threads :
+      thread.start()
+   for thread in threads :
+      thread.join()
+
+   for realization in range(4) :
+      assert(np.array_equal(results[realization], expected[realization]))
+
+   # The global pool is back in use outside of the with block
+   set_seed(5)
+   assert(gen_random()==np.random.default_rng(5).random())
+
+
+def _sample_twice() :
+   return [sample_dist("Normal", 10.0, 2.0) for _ in range(2)]
+
+
+def test_sampling_counters() :
+
+   reset_sampling_counters()
+
+   # Nothing is counted while the counters are disabled
+   sample_dist("Lognormal", 5.0, 0.2)
+   assert(get_sampling_counts()=={})
+
+   enable_sampling_counters()
+   try :
+      _sample_twice()
+      sample_dist_array("Lognormal", 5.0, 0.2, size=(2, 3))
+      get_percentile("Lognormal", 5.0, 0.2, np.array([1.0, 2.0, 3.0]))
+   finally :
+      enable_sampling_counters(False)
+
+   counts = get_sampling_counts()
+
+   # Keyed by function, distribution and calling site
+   assert(counts[("sample_dist", "normal", f"{__name__}._sample_twice")]=={"calls" : 2, "values" : 2})
+   assert(counts[("sample_dist_array", "lognormal", f"{__name__}.test_sampling_counters")]=={"calls" : 1, "values" : 6})
+   assert(counts[("get_percentile", "lognormal", f"{__name__}.test_sampling_counters")]=={"calls" : 1, "values" : 3})
+   assert(len(counts)==3)
+
+   reset_sampling_counters()
@@ -0,0 +1,40 @@
+from go_redi import go_redi
+from utils.timing_utils import enable_timing, reset_timings, get_timings, get_timing_report, timed
+
+
+def test_stage_timings(test_building_2,
+                       test_component_library_1) :
+
+   reset_timings()
+
+   # Nothing is recorded while the timings are disabled
+   go_redi(building_dict=test_building_2, components_lib_dict=test_component_library_1, seed=123)
+   assert(get_timings()=={})
+
+   enable_timing()
+   try :
+      for _ in range(2) :
+         go_redi(building_dict=test_building_2, components_lib_dict=test_component_library_1, seed=123)
+
+      with timed("write_results") :
+         pass
+   finally :
+      enable_timing(False)
+
+   # The timings of the last run, and of both runs
+   timings = get_timings()
+   total_timings = get_timings(aggregate=True)
+
+   for stage in ["damage_aggregation", "assign_repair_class", "get_impeding_delays", "get_structural_repair_time",
+                 "get_repair_schedule", "output_results"] :
+      assert(timings[stage]["calls"]==1)
+      assert(total_timings[stage]["calls"]==2)
+      assert(total_timings[stage]["time"] >= timings[stage]["time"] > 0.0)
+
+   # One scheduling per repair goal
+   assert(timings["synchronous_alloc"]["calls"]==3)
+   assert(timings["write_results"]["calls"]==1)
+
+   assert("get_repair_schedule" in get_timing_report(total_time=1.0))
+
+   reset_timings()
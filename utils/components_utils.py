@@ -0,0 +1,371 @@
+import os, json, hashlib, argparse, tempfile, zipfile
+
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Any, Optional, Tuple
+
+# Version of the compiled library format, bump it whenever the arrays stored change
+COMPILED_LIBRARY_VERSION = 1
+
+# Version of the components index format
+COMPONENTS_INDEX_VERSION = 1
+
+# Fields of a component used by the engine, the only ones kept in the compiled library
+ENGINE_FIELDS = ["seq", "rds", "n_ds", "long_lead"]
+
+
+def get_file_hash(path : Path) -> str :
+
+    with open(path, 'rb') as f :
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_cache_dir() -> Path :
+
+    # Directory of the compiled libraries and indices: $REDI_CACHE_DIR, else the user cache directory, i.e.,
+    # $XDG_CACHE_HOME/pyredi or ~/.cache/pyredi. Nothing is written next to the source JSON, e.g. in the package data
+    cache_dir = os.environ.get("REDI_CACHE_DIR")
+    if cache_dir :
+        return Path(cache_dir)
+
+    return Path(os.environ.get("XDG_CACHE_HOME") or Path.home()/'.cache')/'pyredi'
+
+
+def get_cache_path(json_path : Path,
+                   suffix : str) -> Path :
+
+    # One file per source JSON, named after it and the hash of its absolute path so files with the same name do not collide
+    json_path = Path(json_path).resolve()
+    path_hash = hashlib.sha256(str(json_path).encode('utf-8')).hexdigest()[:16]
+
+    return get_cache_dir()/f"{json_path.stem}-{path_hash}{suffix}"
+
+
+def get_compiled_library_path(json_path : Path) -> Path :
+
+    # The compiled library is kept in the cache directory, e.g. ~/.cache/pyredi/components_library-<hash>.npz
+    return get_cache_path(json_path, '.npz')
+
+
+def compile_components_library(components_lib_dict : Dict[str,Any],
+                               source_hash : str,
+                               out_path : Path) :
+
+    """
+    Compiles the components library into a .npz file with the fields used by the engine, as given by get_components_arrays
+
+    Args:
+    components_lib_dict (dict): components library
+    source_hash (str): hash of the source JSON file, used to invalidate the compiled library
+    out_path (Path): path of the compiled library
+    """
+
+    arrays = {"version" : COMPILED_LIBRARY_VERSION,
+              "source_hash" : source_hash,
+              **get_components_arrays(components_lib_dict)}
+
+    save_npz(out_path, arrays)
+
+
+def get_components_arrays(components_lib_dict : Dict[str,Any]) -> Dict[str,np.ndarray] :
+
+    """
+    Converts the fields used by the engine to arrays with one row per component, in the order of the library
+
+    The lists of each component (rds and long_lead) are zero-padded to the longest one and their lengths returned alongside.
+
+    Args:
+    components_lib_dict (dict): components library
+
+    Returns:
+    dict: the arrays nistr, seq, n_ds, rds, rds_len, long_lead, long_lead_len and has_long_lead
+    """
+
+    components = list(components_lib_dict.values())
+    n_components = len(components)
+
+    seq = np.array([component["seq"] for component in components], dtype=int) if n_components else np.zeros((0, 2), dtype=int)
+    n_ds = np.array([component["n_ds"] for component in components], dtype=int)
+
+    # Repair classes of each damage state
+    rds_len = np.array([len(component["rds"]) for component in components], dtype=int)
+    rds = np.zeros((n_components, max(rds_len, default=0)), dtype=int)
+    for i, component in enumerate(components) :
+        rds[i, :rds_len[i]] = component["rds"]
+
+    # Long lead times of each damage state (days), not every component has them
+    has_long_lead = np.array(["long_lead" in component for component in components], dtype=bool)
+    long_lead_values = [component.get("long_lead", []) for component in components]
+    long_lead_len = np.array([len(values) for values in long_lead_values], dtype=int)
+
+    # Keep integers as integers so the values read back are the same as in the JSON
+    dtype = np.result_type(*[np.array(values) for values in long_lead_values if len(values)]) if np.any(long_lead_len) else int
+    long_lead = np.zeros((n_components, max(long_lead_len, default=0)), dtype=dtype)
+    for i, values in enumerate(long_lead_values) :
+        long_lead[i, :long_lead_len[i]] = values
+
+    return {"nistr" : np.array(list(components_lib_dict.keys()), dtype=str),
+            "seq" : seq,
+            "n_ds" : n_ds,
+            "rds" : rds,
+            "rds_len" : rds_len,
+            "long_lead" : long_lead,
+            "long_lead_len" : long_lead_len,
+            "has_long_lead" : has_long_lead}
+
+
+def save_npz(out_path : Path,
+             arrays : Dict[str,Any]) :
+
+    Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+
+    # Write to a temporary file first, so that other processes never read a partially written file
+    fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=Path(out_path).parent)
+    os.close(fd)
+
+    try :
+        np.savez(tmp_path, **arrays)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, out_path)
+    finally :
+        if os.path.exists(tmp_path) :
+            os.remove(tmp_path)
+
+
+def read_npz(path : Path) -> Optional[Dict[str,np.ndarray]] :
+
+    try :
+        with np.load(path, allow_pickle=False) as data :
+            return {key : data[key] for key in data.files}
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) :
+        return None
+
+
+def read_compiled_components_library(path : Path,
+                                     source_hash : Optional[str]=None) -> Optional[Dict[str,Any]] :
+
+    """
+    Reads a compiled components library
+
+    Returns None if the compiled library cannot be read, is of an older format or was compiled from a different
+    source, i.e., its hash is not source_hash.
+
+    Args:
+    path (Path): path of the compiled library
+    source_hash (str): hash of the source JSON file (optional - not checked if None)
+
+    Returns:
+    dict: components library with the fields used by the engine, i.e., seq, rds, n_ds and long_lead
+    """
+
+    arrays = read_npz(path)
+
+    if arrays is None or int(arrays.get("version", -1)) != COMPILED_LIBRARY_VERSION :
+        return None
+
+    if source_hash is not None and str(arrays["source_hash"]) != source_hash :
+        return None
+
+    # Convert back to lists of python types, i.e., the same as json.load
+    nistr = arrays["nistr"].tolist()
+    seq = arrays["seq"].tolist()
+    n_ds = arrays["n_ds"].tolist()
+    rds = arrays["rds"].tolist()
+    rds_len = arrays["rds_len"].tolist()
+    long_lead = arrays["long_lead"].tolist()
+    long_lead_len = arrays["long_lead_len"].tolist()
+    has_long_lead = arrays["has_long_lead"].tolist()
+
+    components_lib_dict = {}
+    for i, NISTR in enumerate(nistr) :
+        component = {"seq" : seq[i], "rds" : rds[i][:rds_len[i]], "n_ds" : n_ds[i]}
+
+        if has_long_lead[i] :
+            component["long_lead"] = long_lead[i][:long_lead_len[i]]
+
+        components_lib_dict[NISTR] = component
+
+    return components_lib_dict
+
+
+def load_components_library_file(json_path : Path,
+                                 compiled_path : Optional[Path]=None) -> Dict[str,Any] :
+
+    """
+    Loads the fields used by the engine from a components library JSON file, through its compiled library
+
+    The compiled library is rebuilt whenever the JSON file changes (its hash is stored in the compiled library),
+    if it cannot be written the JSON file is used directly.
+
+    Args:
+    json_path (Path): path of the components library JSON file
+    compiled_path (Path): path of the compiled library (optional - defaults to get_compiled_library_path, in the cache directory)
+
+    Returns:
+    dict: components library with the fields used by the engine, i.e., seq, rds, n_ds and long_lead
+    """
+
+    compiled_path = compiled_path or get_compiled_library_path(json_path)
+
+    source_hash = get_file_hash(json_path)
+
+    components_lib_dict = read_compiled_components_library(compiled_path, source_hash=source_hash)
+
+    if components_lib_dict is not None :
+        return components_lib_dict
+
+    with open(json_path) as f :
+        components_lib_dict = json.load(f)
+
+    try :
+        compile_components_library(components_lib_dict, source_hash=source_hash, out_path=compiled_path)
+    except OSError :
+        pass
+
+    return {NISTR: {key: component[key] for key in ENGINE_FIELDS if key in component} for NISTR, component in components_lib_dict.items()}
+
+
+def get_components_index_path(json_path : Path) -> Path :
+
+    # The index is kept in the cache directory, e.g. ~/.cache/pyredi/components_library-<hash>.index.npz
+    return get_cache_path(json_path, '.index.npz')
+
+
+def build_components_index(json_path : Path) -> Tuple[List[str], np.ndarray] :
+
+    """
+    Finds where every component is in a components library JSON file
+
+    Args:
+    json_path (Path): path of the components library JSON file
+
+    Returns:
+    tuple: the NISTR of every component, in the order of the file, and the [start, end) byte offsets of each component
+    """
+
+    with open(json_path, 'rb') as f :
+        raw = f.read()
+
+    text = raw.decode('utf-8')
+
+    decoder = json.JSONDecoder()
+    whitespace = json.decoder.WHITESPACE
+
+    nistrs = []
+    char_offsets = []
+
+    # Walk the top-level object, i.e., {"NISTR" : {...}, ...}
+    idx = whitespace.match(text, 0).end()
+    if text[idx:idx+1] != '{' :
+        raise ValueError(f"Error, the components library {json_path} is not a JSON object")
+
+    idx = whitespace.match(text, idx + 1).end()
+    while text[idx:idx+1] != '}' :
+
+        NISTR, idx = json.decoder.scanstring(text, idx + 1)
+
+        idx = whitespace.match(text, idx).end()
+        if text[idx:idx+1] != ':' :
+            raise ValueError(f"Error, invalid components library {json_path}, expected ':' at character {idx}")
+
+        start = whitespace.match(text, idx + 1).end()
+        _, end = decoder.raw_decode(text, start)
+
+        nistrs.append(NISTR)
+        char_offsets.append((start, end))
+
+        idx = whitespace.match(text, end).end()
+        if text[idx:idx+1] == ',' :
+            idx = whitespace.match(text, idx + 1).end()
+
+    # Convert the character offsets to byte offsets (the same for ASCII files)
+    offsets = np.zeros((len(char_offsets), 2), dtype=np.int64)
+    byte_position, char_position = 0, 0
+    for i, (start, end) in enumerate(char_offsets) :
+        byte_position += len(text[char_position:start].encode('utf-8'))
+        offsets[i, 0] = byte_position
+        byte_position += len(text[start:end].encode('utf-8'))
+        offsets[i, 1] = byte_position
+        char_position = end
+
+    return nistrs, offsets
+
+
+def load_components_index(json_path : Path,
+                          index_path : Optional[Path]=None) -> Dict[str,Tuple[int,int]] :
+
+    """
+    Loads the index of a components library JSON file, i.e., the byte offsets of every component
+
+    The index is stored in the cache directory and rebuilt whenever the JSON file changes (its hash is stored in the index),
+    if it cannot be written it is rebuilt on every load.
+
+    Args:
+    json_path (Path): path of the components library JSON file
+    index_path (Path): path of the index (optional - defaults to get_components_index_path, in the cache directory)
+
+    Returns:
+    dict: the [start, end) byte offsets of each component, by NISTR
+    """
+
+    index_path = index_path or get_components_index_path(json_path)
+
+    source_hash = get_file_hash(json_path)
+
+    arrays = read_npz(index_path)
+
+    if arrays is None or int(arrays.get("version", -1)) != COMPONENTS_INDEX_VERSION or str(arrays["source_hash"]) != source_hash :
+
+        nistrs, offsets = build_components_index(json_path)
+
+        arrays = {"version" : COMPONENTS_INDEX_VERSION,
+                  "source_hash" : source_hash,
+                  "nistr" : np.array(nistrs, dtype=str),
+                  "offsets" : offsets}
+        try :
+            save_npz(index_path, arrays)
+        except OSError :
+            pass
+
+    return dict(zip(arrays["nistr"].tolist(), map(tuple, arrays["offsets"].tolist())))
+
+
+def read_components(json_path : Path,
+                    offsets : Dict[str,Tuple[int,int]]) -> Dict[str,Any] :
+
+    # Read and parse only the requested components
+    components = {}
+    with open(json_path, 'rb') as f :
+        for NISTR, (start, end) in offsets.items() :
+            f.seek(start)
+            components[NISTR] = json.loads(f.read(end - start).decode('utf-8'))
+
+    return components
+
+
+if __name__ == "__main__":
+
+    default_json_path = Path(__file__).resolve().parent.parent/'data/components_library.json'
+
+    parser = argparse.ArgumentParser(description='Compiles a components library JSON file, and builds its index, for faster loading')
+    parser.add_argument('-c', type=str, default=str(default_json_path), help='Path to the components JSON file [str] (optional - the built-in library if blank)')
+    parser.add_argument('-o', type=str, default=None, help='Path of the compiled library [str] (optional - in the cache directory, $REDI_CACHE_DIR or ~/.cache/pyredi, if blank)')
+    parser.add_argument('-i', type=str, default=None, help='Path of the index [str] (optional - in the cache directory if blank)')
+
+    args = parser.parse_args()
+
+    json_path = Path(args.c)
+    out_path = Path(args.o) if args.o else get_compiled_library_path(json_path)
+    index_path = Path(args.i) if args.i else get_components_index_path(json_path)
+
+    with open(json_path) as f :
+        components_lib_dict = json.load(f)
+
+    compile_components_library(components_lib_dict, source_hash=get_file_hash(json_path), out_path=out_path)
+
+    print(f"Compiled {len(components_lib_dict)} components from {json_path} to {out_path}")
+
+    # Index for the lazy components library
+    load_components_index(json_path, index_path=index_path)
+
+    print(f"Indexed {json_path} in {index_path}")
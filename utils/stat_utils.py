@@ -1,11 +1,94 @@
 
+import sys, threading
 import numpy as np
-from scipy.stats import lognorm, truncnorm, uniform
-from typing import List
+from contextlib import contextmanager
+from scipy.stats import truncnorm, uniform
+from scipy.special import ndtr, ndtri, ndtri_exp, log_ndtr, log1p
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+class RandomPool() :
+
+    """
+    Buffered source of uniform random numbers
+    
+    Uniform random numbers are drawn from the generator in blocks and handed out one by one (or as arrays) 
+    in the order they were drawn, so the numbers returned are exactly the ones that repeated calls to 
+    generator.random() would give. A new block is only drawn once the current one is used up.
+    """
+
+    def __init__(self, 
+                 generator : np.random.Generator, 
+                 block_size : int = 4096) :
+
+        self.generator = generator
+        self.block_size = block_size
+        self._block = np.empty(0)
+        self._values : List[float] = []
+        self._position = 0
+        self._size = 0
+
+    def reset(self, 
+              generator : np.random.Generator) :
+
+        # Start over with a new generator, anything left in the buffer is thrown away
+        self.generator = generator
+        self._block = np.empty(0)
+        self._values = []
+        self._position = 0
+        self._size = 0
+
+    def random(self) -> float :
+
+        position = self._position
+
+        if position == self._size :
+            self._refill()
+            position = 0
+
+        self._position = position + 1
+
+        return self._values[position]
+
+    def random_array(self, 
+                     n : int) -> np.ndarray :
+
+        position = self._position
+        available = self._size - position
+
+        if n <= available :
+            self._position = position + n
+            return self._block[position:position+n].copy()
+
+        # Not enough numbers left in the block, take what is left and draw the rest directly
+        rnd_nums = np.concatenate([self._block[position:], self.generator.random(n - available)])
+        self._position = self._size
+
+        return rnd_nums
+
+    def discard(self, 
+                n : int) :
+
+        # Skip n random numbers, e.g., for the burn in
+        available = self._size - self._position
+
+        if n <= available :
+            self._position += n
+        else :
+            self.generator.random(n - available)
+            self._position = self._size
+
+    def _refill(self) :
+
+        self._block = self.generator.random(self.block_size)
+        self._values = self._block.tolist()
+        self._position = 0
+        self._size = self.block_size
+
 
 # Global values
 RANDOM_SEED = None
 rng = np.random.default_rng()
+random_pool = RandomPool(rng)
 
 
 def set_seed(seed : int = 0, 
@@ -17,24 +100,158 @@ def set_seed(seed : int = 0,
     if seed : 
         RANDOM_SEED = seed
         rng = np.random.default_rng(seed=seed)
+        random_pool.reset(rng)
     
     if burn_in :
-       test = rng.random(burn_in)
-    #    for val in test : 
-    #        print(val)
+       random_pool.discard(burn_in)
+
+
+# Pools set with use_random_pool, one per thread
+_thread_state = threading.local()
+
+# Calls of the sampling functions (sample_dist, sample_dist_array and get_percentile), only counted when enabled 
+# (see enable_sampling_counters). Keyed by (function, distribution, calling site), the number of calls and of values
+_count_sampling_calls = False
+_sampling_counts : Dict[Tuple[str,str,str],List[int]] = {}
+_sampling_counts_lock = threading.Lock()
+
+
+def get_random_pool() -> RandomPool :
+
+    # The pool of the current thread, falls back to the global pool (seeded with set_seed)
+    return getattr(_thread_state, 'pool', random_pool)
+
+
+@contextmanager
+def use_random_pool(pool : RandomPool) -> Iterator[RandomPool] :
+
+    """
+    Draws all the random numbers of the current thread from pool inside the with block
+    
+    Args:
+    pool (RandomPool): the pool to draw from, e.g., from get_realization_pool
+    """
+
+    previous = getattr(_thread_state, 'pool', None)
+    _thread_state.pool = pool
+
+    try :
+        yield pool
+    finally :
+        if previous is None :
+            del _thread_state.pool
+        else :
+            _thread_state.pool = previous
+
+
+def new_entropy() -> int :
+
+    # Fresh entropy from the OS, keep it to reproduce an unseeded run
+    return np.random.SeedSequence().entropy
+
+
+def get_realization_pool(entropy : int, 
+                         realization : int, 
+                         burn_in : int = 0) -> RandomPool :
+
+    """
+    Gets the random pool of a realization, independent of every other realization
+    
+    The stream is the child with index realization of np.random.SeedSequence(entropy), i.e., the same as 
+    SeedSequence(entropy).spawn(n)[realization], so a realization always gets the same random numbers 
+    no matter how many realizations are run, on how many workers or in which order.
+    
+    Args:
+    entropy (int): seed of the run
+    realization (int): index of the realization
+    burn_in (int): number of random numbers to discard at the start of the stream
+    
+    Returns:
+    RandomPool: pool drawing from the stream of the realization
+    """
+
+    seed_sequence = np.random.SeedSequence(entropy=entropy, spawn_key=(realization,))
+    pool = RandomPool(np.random.default_rng(seed_sequence))
+
+    if burn_in :
+        pool.discard(burn_in)
+
+    return pool
 
 
 def gen_random() -> float :
-    rnd_num = rng.random()
-    # print(rnd_num)
 
-    return rnd_num
+    # All random numbers come from the pool, so that the order of consumption is the same as drawing them one at a time
+    return getattr(_thread_state, 'pool', random_pool).random()
+
+
+def gen_random_array(size : Union[int, Tuple[int, ...]]) -> np.ndarray :
+
+    # Consumes the random numbers in the same order as calling gen_random() repeatedly (C-order for n-d shapes)
+    shape = (size,) if np.isscalar(size) else tuple(size)
+    n = int(np.prod(shape))
+
+    return get_random_pool().random_array(n).reshape(shape)
+
+
+def enable_sampling_counters(enabled : bool = True) :
+
+    global _count_sampling_calls
+
+    _count_sampling_calls = enabled
+
+
+def reset_sampling_counters() :
+
+    with _sampling_counts_lock :
+        _sampling_counts.clear()
+
+
+def get_sampling_counts() -> Dict[Tuple[str,str,str],Dict[str,int]] :
+
+    # Number of calls and of values sampled (or evaluated) by (function, distribution, calling site)
+    with _sampling_counts_lock :
+        return {key: {"calls" : calls, "values" : values} for key, (calls, values) in _sampling_counts.items()}
+
+
+def get_sampling_report() -> str :
+
+    counts = get_sampling_counts()
+
+    if not counts :
+        return "Sampling calls: nothing recorded"
+
+    lines = ["Sampling calls", f"{'function':<20}{'distribution':<14}{'calling site':<64}{'calls':>8}{'values':>10}"]
+
+    for (function, distribution, caller), count in sorted(counts.items(), key=lambda item: -item[1]["calls"]) :
+        lines.append(f"{function:<20}{distribution:<14}{caller:<64}{count['calls']:>8}{count['values']:>10}")
+
+    return "\n".join(lines)
+
+
+def _count_sampling_call(function : str,
+                         distribution : str,
+                         n_values : int) :
+
+    # The calling site is the function that called function, two frames up from here (skipping comprehensions)
+    frame = sys._getframe(2)
+    while frame.f_back is not None and frame.f_code.co_name in ("<listcomp>", "<dictcomp>", "<setcomp>", "<genexpr>") :
+        frame = frame.f_back
+    caller = f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}"
+
+    with _sampling_counts_lock :
+        count = _sampling_counts.setdefault((function, str(distribution).lower(), caller), [0, 0])
+        count[0] += 1
+        count[1] += n_values
 
 
 def sample_dist(distribution : str,
                 var1 : float,
                 var2 : float) :
 
+    if _count_sampling_calls :
+        _count_sampling_call("sample_dist", distribution, 1)
+
     # Lognormal sample
     if distribution.lower() in ["lognormal", "log normal"]:
         mean = var1
@@ -45,7 +262,7 @@ def sample_dist(distribution : str,
         if mean == 0.0 : 
             return 0.0 
 
-        return lognorm.ppf(rnd_num, s=beta, scale=np.exp(np.log(mean)))
+        return lognormal_ppf(rnd_num, mean, beta)
 
     # Normal sample
     # We are assuming every normally distributed variable is actually truncated at zero
@@ -53,7 +270,7 @@ def sample_dist(distribution : str,
         mean = var1
         stdev = var2
         rnd_num = gen_random()
-        return truncnorm.ppf(rnd_num, a=(0-mean)/stdev, b=np.inf, loc=mean, scale=stdev)
+        return _truncnorm_ppf_scalar(rnd_num, mean, stdev)
 
     # Uniform sample
     elif distribution.lower() == "uniform":
@@ -67,10 +284,230 @@ def sample_dist(distribution : str,
         raise ValueError(f"Error: Invalid distribution specified. {distribution} does not have a sampling function")
 
 
+def sample_dist_array(distribution : str,
+                      var1 : Union[float, np.ndarray],
+                      var2 : Union[float, np.ndarray],
+                      size : Optional[Union[int, Tuple[int, ...]]] = None) -> np.ndarray :
+
+    """
+    Vectorized version of sample_dist, samples an array of values in a single call
+    
+    The parameters are broadcast against each other (and against size if provided). One random number 
+    is consumed per sample in C-order, so the result is identical to calling sample_dist element by element.
+    
+    Args:
+    distribution (str): type of distribution
+    var1 (float or np.ndarray): first parameter of distribution
+    var2 (float or np.ndarray): second parameter of distribution
+    size (int or tuple): shape of the output (optional - defaults to the broadcast shape of the parameters)
+    
+    Returns:
+    np.ndarray: array of samples
+    """
+
+    var1 = np.asarray(var1, dtype=np.float64)
+    var2 = np.asarray(var2, dtype=np.float64)
+
+    if size is None :
+        shape = np.broadcast_shapes(var1.shape, var2.shape)
+    else :
+        shape = (size,) if np.isscalar(size) else tuple(size)
+
+    var1 = np.broadcast_to(var1, shape)
+    var2 = np.broadcast_to(var2, shape)
+
+    # Check the distribution before consuming any random numbers
+    dist = distribution.lower()
+    if dist not in ["lognormal", "log normal", "normal", "uniform"] :
+        raise ValueError(f"Error: Invalid distribution specified. {distribution} does not have a sampling function")
+
+    if _count_sampling_calls :
+        _count_sampling_call("sample_dist_array", distribution, int(np.prod(shape)))
+
+    rnd_num = gen_random_array(shape)
+
+    if rnd_num.size == 0 :
+        return np.zeros(shape)
+
+    # Lognormal sample
+    if dist in ["lognormal", "log normal"]:
+        mean = var1
+        beta = var2
+
+        # A zero mean gives a zero sample, but the random number is still consumed to keep the stream in sync
+        samples = np.zeros(shape)
+        nonzero = mean != 0.0
+        samples[nonzero] = lognormal_ppf(rnd_num[nonzero], mean[nonzero], beta[nonzero])
+        return samples
+
+    # Normal sample
+    # We are assuming every normally distributed variable is actually truncated at zero
+    elif dist == "normal":
+        mean = var1
+        stdev = var2
+        return truncnorm_ppf(rnd_num, mean, stdev)
+
+    # Uniform sample
+    else:
+        lower_bound = var1
+        upper_bound = var2
+        return np.asarray(uniform.ppf(rnd_num, loc=lower_bound, scale=upper_bound-lower_bound))
+
+
+def lognormal_ppf(rnd_num : Union[float, np.ndarray],
+                  mean : Union[float, np.ndarray],
+                  beta : Union[float, np.ndarray]) :
+
+    """
+    Closed-form inverse CDF of the lognormal distribution, i.e., mean * exp(beta * Phi^-1(rnd_num))
+    
+    Evaluated in the same order of operations as lognorm.ppf(rnd_num, s=beta, scale=np.exp(np.log(mean))), 
+    so the result is bit-identical but without the per-call overhead of scipy.stats
+    
+    Args:
+    rnd_num (float or np.ndarray): uniform random number(s) in [0,1)
+    mean (float or np.ndarray): median of the distribution
+    beta (float or np.ndarray): logarithmic standard deviation
+    
+    Returns:
+    float or np.ndarray: the sample(s) associated with rnd_num
+    """
+
+    return np.exp(beta * ndtri(rnd_num)) * np.exp(np.log(mean))
+
+
+def lognormal_cdf(x : Union[float, np.ndarray],
+                  mean : Union[float, np.ndarray],
+                  beta : Union[float, np.ndarray]) :
+
+    """
+    Closed-form CDF of the lognormal distribution, i.e., Phi(ln(x / mean) / beta)
+    
+    Evaluated in the same order of operations as lognorm.cdf(x, s=beta, scale=np.exp(np.log(mean))), 
+    so the result is bit-identical but without the per-call overhead of scipy.stats
+    
+    Args:
+    x (float or np.ndarray): random variable(s)
+    mean (float or np.ndarray): median of the distribution
+    beta (float or np.ndarray): logarithmic standard deviation
+    
+    Returns:
+    float or np.ndarray: the percentile(s) associated with x
+    """
+
+    # The support is x > 0, the CDF is zero elsewhere
+    with np.errstate(divide='ignore', invalid='ignore') :
+        p = ndtr(np.log(x / np.exp(np.log(mean))) / beta)
+
+    return np.where(np.asarray(x) > 0, p, 0.0)[()]
+
+
+def truncnorm_ppf(rnd_num : Union[float, np.ndarray],
+                  mean : Union[float, np.ndarray],
+                  stdev : Union[float, np.ndarray]) -> np.ndarray :
+
+    """
+    Inverse CDF of the normal distribution truncated at zero, i.e., truncnorm with a=(0-mean)/stdev and b=inf
+    
+    Works in log space with ndtri_exp and log_ndtr, so it is stable in both tails. The operations mirror 
+    truncnorm.ppf (lower tail for a positive mean, upper tail through symmetry otherwise), so the result is 
+    bit-identical to scipy but without the per-call overhead of scipy.stats
+    
+    Args:
+    rnd_num (float or np.ndarray): uniform random number(s) in [0,1)
+    mean (float or np.ndarray): mean of the untruncated distribution
+    stdev (float or np.ndarray): standard deviation of the untruncated distribution
+    
+    Returns:
+    np.ndarray: the sample(s) associated with rnd_num, 0-d for scalar inputs
+    """
+
+    # Scalar inputs skip the array machinery
+    if np.ndim(rnd_num) == 0 and np.ndim(mean) == 0 and np.ndim(stdev) == 0 :
+        return np.asarray(_truncnorm_ppf_scalar(float(rnd_num), float(mean), float(stdev)))
+
+    rnd_num, mean, stdev = np.broadcast_arrays(np.asarray(rnd_num, dtype=np.float64), 
+                                               np.asarray(mean, dtype=np.float64), 
+                                               np.asarray(stdev, dtype=np.float64))
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+
+        # Lower truncation point in standard normal space
+        a = (0-mean)/stdev
+
+        x = np.empty(a.shape)
+
+        # Positive mean: invert the CDF in the lower tail
+        left = a < 0
+        if np.any(left) :
+            a_left = a[left]
+            log_mass = log1p(-ndtr(a_left))
+            x[left] = ndtri_exp(_log_sum_exp(log_ndtr(a_left), np.log(rnd_num[left]) + log_mass))
+
+        # Otherwise invert the survival function in the upper tail
+        right = ~left
+        if np.any(right) :
+            a_right = a[right]
+            log_mass = np.where(a_right > 0, log_ndtr(-a_right), log1p(-ndtr(a_right)))
+            x[right] = -ndtri_exp(np.log1p(-rnd_num[right]) + log_mass)
+
+        samples = x * stdev + mean
+
+        # Bounds of the distribution and invalid parameters
+        samples = np.where(rnd_num == 0.0, a * stdev + mean, samples)
+        samples = np.where(rnd_num == 1.0, np.inf, samples)
+        samples = np.where(stdev > 0, samples, np.nan)
+
+    return samples
+
+
+def _truncnorm_ppf_scalar(rnd_num : float,
+                          mean : float,
+                          stdev : float) -> float :
+
+    # Same steps as truncnorm_ppf, for a single sample
+    if not stdev > 0 :
+        return np.nan
+
+    a = (0-mean)/stdev
+
+    if rnd_num == 0.0 :
+        return a * stdev + mean
+    elif rnd_num == 1.0 :
+        return np.inf
+
+    if a > 0 :
+        log_mass = log_ndtr(-a)
+    else :
+        log_mass = log1p(-ndtr(a))
+
+    if a < 0 :
+        log_p = log_ndtr(a)
+        log_q = np.log(rnd_num) + log_mass
+        log_max = max(log_p, log_q)
+        if not np.isfinite(log_max) :
+            log_max = 0.0
+        x = ndtri_exp(np.log(np.exp(log_p - log_max) + np.exp(log_q - log_max)) + log_max)
+    else :
+        x = -ndtri_exp(np.log1p(-rnd_num) + log_mass)
+
+    return x * stdev + mean
+
+
+def _log_sum_exp(log_p : np.ndarray, 
+                 log_q : np.ndarray) -> np.ndarray :
+
+    # log(p + q) from log(p) and log(q), same steps as scipy.special.logsumexp over two terms
+    log_max = np.maximum(log_p, log_q)
+    log_max = np.where(np.isfinite(log_max), log_max, 0.0)
+
+    return np.log(np.exp(log_p - log_max) + np.exp(log_q - log_max)) + log_max
+
+
 def get_percentile(distribution : str,
                    var1 : float,
                    var2: float,
-                   x : float) :
+                   x : Union[float, np.ndarray]) :
 
     """
     Gets the percentile (from CDF) associated with a distribution and random variable x
@@ -79,17 +516,20 @@ def get_percentile(distribution : str,
     distribution (str): type of distribution
     var1 (float): first parameter of distribution
     var2 (float): second parameter of distribution
-    x (float): random variable
+    x (float or np.ndarray): random variable(s)
     
     Returns:
-    float: percentile (from CDF) associated with a distribution and random variable x
+    float or np.ndarray: percentile (from CDF) associated with a distribution and random variable x
     """
+
+    if _count_sampling_calls :
+        _count_sampling_call("get_percentile", distribution, int(np.size(x)))
     
     # Lognormal distribution
     if distribution.lower() == "lognormal":
         mean = var1
         beta = var2
-        return lognorm.cdf(x, s=beta, scale=np.exp(np.log(mean)))
+        return lognormal_cdf(x, mean, beta)
     
     # Normal distribution
     # We are assuming every normally distributed variable is actually truncated at zero
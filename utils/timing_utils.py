@@ -0,0 +1,176 @@
+import io, time, functools, threading, cProfile, pstats
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, Iterator, List, Optional
+
+# Stage timings, only recorded when enabled (see enable_timing). Every stage keeps its number of calls and its total
+# wall time, both for the current run (reset by start_timing_run) and for all the runs since the timings were enabled
+_enabled = False
+_run_timings : Dict[str,List[float]] = {}
+_total_timings : Dict[str,List[float]] = {}
+_timings_lock = threading.Lock()
+
+
+def enable_timing(enabled : bool = True) :
+
+    global _enabled
+
+    _enabled = enabled
+
+
+def is_timing_enabled() -> bool :
+    return _enabled
+
+
+def reset_timings() :
+
+    with _timings_lock :
+        _run_timings.clear()
+        _total_timings.clear()
+
+
+def start_timing_run() :
+
+    # A new run, e.g. a call to go_redi, the aggregate timings are kept
+    if _enabled :
+        with _timings_lock :
+            _run_timings.clear()
+
+
+def record_timing(stage : str,
+                  elapsed : float) :
+
+    with _timings_lock :
+        for timings in (_run_timings, _total_timings) :
+            calls_and_time = timings.setdefault(stage, [0, 0.0])
+            calls_and_time[0] += 1
+            calls_and_time[1] += elapsed
+
+
+@contextmanager
+def _timed(stage : str) -> Iterator[None] :
+
+    start = time.perf_counter()
+    try :
+        yield
+    finally :
+        record_timing(stage, time.perf_counter() - start)
+
+
+def timed(stage : str) :
+
+    # Context manager timing a block of code, nothing is done when the timings are disabled
+    return _timed(stage) if _enabled else nullcontext()
+
+
+def timed_stage(stage : str) -> Callable :
+
+    """
+    Decorator recording the wall time and the number of calls of a function under stage
+
+    When the timings are disabled the function is called directly, i.e., the only overhead is one flag check.
+    """
+
+    def decorator(func : Callable) -> Callable :
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs) :
+
+            if not _enabled :
+                return func(*args, **kwargs)
+
+            start = time.perf_counter()
+            try :
+                return func(*args, **kwargs)
+            finally :
+                record_timing(stage, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def get_timings(aggregate : bool = False) -> Dict[str,Dict[str,float]] :
+
+    # Number of calls and total wall time (seconds) of each stage, for the current run or for all runs
+    with _timings_lock :
+        timings = _total_timings if aggregate else _run_timings
+        return {stage: {"calls" : int(calls), "time" : elapsed} for stage, (calls, elapsed) in timings.items()}
+
+
+def get_timing_report(aggregate : bool = False,
+                      total_time : Optional[float] = None) -> str :
+
+    """
+    Formats the stage timings as a table, the slowest stages first
+
+    Args:
+    aggregate (bool): report the timings of all the runs instead of the current run
+    total_time (float): wall time of the whole run (seconds), used for the share of each stage (optional - not shown if None)
+
+    Returns:
+    str: the report
+    """
+
+    timings = get_timings(aggregate=aggregate)
+
+    title = "Stage timings (all runs)" if aggregate else "Stage timings"
+
+    if not timings :
+        return f"{title}: nothing recorded"
+
+    lines = [title, f"{'stage':<28}{'calls':>8}{'total [s]':>12}{'mean [ms]':>12}" + (f"{'share':>8}" if total_time else "")]
+
+    for stage, timing in sorted(timings.items(), key=lambda item: -item[1]["time"]) :
+        line = f"{stage:<28}{timing['calls']:>8}{timing['time']:>12.4f}{1000.0 * timing['time'] / timing['calls']:>12.3f}"
+        if total_time :
+            line += f"{100.0 * timing['time'] / total_time:>7.1f}%"
+        lines.append(line)
+
+    return "\n".join(lines)
+
+
+@contextmanager
+def profiled(profiler : Optional[str] = None,
+             n_lines : int = 30) -> Iterator[None] :
+
+    """
+    Runs the with block under a profiler and prints its report at the end
+
+    Args:
+    profiler (str): "cprofile" or "pyinstrument" (optional - the block is run as is if None)
+    n_lines (int): number of functions shown in the cProfile report, by cumulative time
+    """
+
+    if profiler is None :
+        yield
+        return
+
+    if profiler == "cprofile" :
+        profile = cProfile.Profile()
+        profile.enable()
+        try :
+            yield
+        finally :
+            profile.disable()
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(n_lines)
+            print(stream.getvalue())
+
+    elif profiler == "pyinstrument" :
+
+        # pyinstrument is an optional dependency, only needed for this profiler
+        try :
+            from pyinstrument import Profiler
+        except ImportError :
+            raise ImportError("Error, pyinstrument is not installed, install it with 'pip install pyinstrument' or use the cprofile profiler")
+
+        profile = Profiler()
+        profile.start()
+        try :
+            yield
+        finally :
+            profile.stop()
+            print(profile.output_text(unicode=True, color=False))
+
+    else :
+        raise ValueError(f"Error, unknown profiler {profiler}, the profilers are cprofile and pyinstrument")